@@ -0,0 +1,329 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from metrics import Counter, Gauge, Histogram
+
+# Telegram cheklovlari: bot uchun ~30 xabar/soniya, bitta chatga ~1 xabar/soniya
+BOT_API_RATE = float(os.getenv("BOT_API_RATE", "30"))
+# Ommaviy yuborish alohida worker jarayon(lar)ida ham ishlaydi va ularning byudjeti
+# bot jarayonining rejalashtiruvchisidan mustaqil. Shuning uchun BROADCAST_RATE
+# (barcha workerlar uchun jami) umumiy chegaradan interaktiv javoblar ulushi
+# (INTERACTIVE_RESERVE) ayirib olinadi: interaktiv trafik shu ulushda qolsa, jami
+# BOT_API_RATE dan oshmaydi.
+INTERACTIVE_RESERVE = float(os.getenv("INTERACTIVE_RESERVE", "10"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", str(max(BOT_API_RATE - INTERACTIVE_RESERVE, 1))))
+BROADCAST_MIN_RATE = float(os.getenv("BROADCAST_MIN_RATE", "2"))
+PER_CHAT_INTERVAL = float(os.getenv("PER_CHAT_INTERVAL", "1"))
+
+
+class RateLimiter:
+    """
+    Token bucket asosidagi tezlik cheklovchi.
+
+    - Global tezlik: soniyasiga `rate` ta so'rov (1 soniyalik portlash bilan)
+    - Har bir chat uchun: kamida `per_chat_interval` soniya oraliq
+    - Flood-wait kelsa: hamma so'rovlar to'xtaydi va tezlik ikki barobar kamayadi,
+      keyin xatosiz ishlaganda asta-sekin qayta oshadi
+    """
+
+    def __init__(self, rate: float, min_rate: float = 1.0, per_chat_interval: float = 0.0):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.flood_waits = 0
+
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._lock = asyncio.Lock()
+        self._chat_next: dict[int, float] = {}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, chat_id: Optional[int] = None):
+        # Navbat tartibi saqlanadi: lock ni kutganlar kelgan tartibda o'tadi
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+        if chat_id is not None and self.per_chat_interval:
+            now = time.monotonic()
+            slot = max(now, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = slot + self.per_chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+    def set_max_rate(self, rate: float):
+        """Yuqori chegarani o'zgartirish (masalan, umumiy tezlik workerlar orasida bo'linganda)."""
+        self.max_rate = max(rate, self.min_rate)
+        self.rate = min(self.rate, self.max_rate)
+
+    def on_success(self):
+        self._successes += 1
+        # ~10 soniya xatosiz ishlasa tezlik 10% ga oshadi
+        if self.rate < self.max_rate and self._successes >= self.rate * 10:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+            self._successes = 0
+
+    def on_flood_wait(self, retry_after: float):
+        self.flood_waits += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = min(self._tokens, self.rate)
+        self._successes = 0
+
+
+# Ommaviy yuborishlar uchun umumiy cheklovchi
+broadcast_limiter = RateLimiter(BROADCAST_RATE, BROADCAST_MIN_RATE, PER_CHAT_INTERVAL)
+
+
+# === Bot API chaqiruvlari uchun umumiy o'ram ===
+
+class CallStatus(str, Enum):
+    OK = "ok"
+    FORBIDDEN = "forbidden"        # Bot bloklangan yoki chatdan chiqarilgan
+    BAD_REQUEST = "bad_request"    # Chat topilmadi, xabar noto'g'ri va h.k.
+    RETRY_EXHAUSTED = "retry_exhausted"
+    ERROR = "error"
+
+
+class CallResult(NamedTuple):
+    status: CallStatus
+    result: Any = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status is CallStatus.OK
+
+
+# Flood-wait kelganda shu jarayondagi barcha call_api chaqiruvlari kutadi
+_paused_until = 0.0
+
+
+def pause_all(seconds: float):
+    global _paused_until
+    _paused_until = max(_paused_until, time.monotonic() + seconds)
+
+
+async def wait_if_paused():
+    delay = _paused_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def call_api(
+    make_request: Callable[[], Awaitable[Any]],
+    limiter: Optional[RateLimiter] = None,
+    chat_id: Optional[int] = None,
+    max_retries: int = 5,
+) -> CallResult:
+    """
+    Bot API so'rovini bajarish va natijani turlarga ajratish.
+
+    :param make_request: Har chaqirilganda yangi so'rov qaytaruvchi funksiya
+    :param limiter: (ixtiyoriy) Tezlik cheklovchi
+    :param chat_id: (ixtiyoriy) Chat bo'yicha oraliq uchun
+    """
+    for _ in range(max_retries):
+        await wait_if_paused()
+        if limiter is not None:
+            await limiter.acquire(chat_id)
+        try:
+            result = await make_request()
+        except TelegramRetryAfter as e:
+            pause_all(e.retry_after + 1)
+            if limiter is not None:
+                limiter.on_flood_wait(e.retry_after + 1)
+            continue
+        except TelegramForbiddenError as e:
+            return CallResult(CallStatus.FORBIDDEN, error=e)
+        except TelegramBadRequest as e:
+            return CallResult(CallStatus.BAD_REQUEST, error=e)
+        except Exception as e:
+            return CallResult(CallStatus.ERROR, error=e)
+        if limiter is not None:
+            limiter.on_success()
+        return CallResult(CallStatus.OK, result)
+    return CallResult(CallStatus.RETRY_EXHAUSTED)
+
+
+# === Chiquvchi so'rovlar rejalashtiruvchisi ===
+# Bot API ning umumiy tezlik byudjeti ikki sinf orasida bo'linadi: interaktiv
+# (foydalanuvchiga javoblar) har doim birinchi, ommaviy (bulk) esa faqat
+# ortib qolgan imkoniyatdan foydalanadi.
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Faqat xabar yuboruvchi/tahrirlovchi metodlar byudjetga kiradi
+THROTTLED_METHOD_PREFIXES = ("send", "copy", "forward", "edit")
+
+_priority: ContextVar[int] = ContextVar("bot_api_priority", default=INTERACTIVE)
+
+queue_depth_metric = Gauge(
+    "bot_api_queue_depth", "Navbatda kutayotgan Bot API so'rovlari", ("priority",)
+)
+queue_wait_metric = Histogram(
+    "bot_api_queue_wait_seconds", "Bot API so'rovining navbatda kutish vaqti", ("priority",)
+)
+
+
+@contextmanager
+def bulk_priority():
+    """Shu blok ichidagi Bot API so'rovlari ommaviy (past) ustuvorlikda yuboriladi."""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class OutboundScheduler:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def queue_depths(self) -> dict:
+        return {(PRIORITY_NAMES[p],): len(q) for p, q in self._queues.items()}
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        started = time.monotonic()
+        now = started
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # Navbat bo'sh va byudjet bor — kutmasdan o'tadi
+        if self._tokens >= 1 and not any(self._queues.values()):
+            self._tokens -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._queues[priority].append(future)
+            self._ensure_dispatcher()
+            self._wakeup.set()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not future.done():
+                    self._queues[priority].remove(future)
+                raise
+        queue_wait_metric.observe(time.monotonic() - started, priority=PRIORITY_NAMES[priority])
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            if not any(self._queues.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            # Eng yuqori ustuvorlikdagi birinchi kutuvchi
+            for priority in sorted(self._queues):
+                queue = self._queues[priority]
+                while queue:
+                    future = queue.popleft()
+                    if not future.done():
+                        future.set_result(None)
+                        self._tokens -= 1
+                        break
+                else:
+                    continue
+                break
+
+
+class SchedulerMiddleware(BaseRequestMiddleware):
+    """Botning barcha chiquvchi so'rovlarini rejalashtiruvchi orqali o'tkazish."""
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", "")
+        if api_method.startswith(THROTTLED_METHOD_PREFIXES):
+            await self.scheduler.acquire(_priority.get())
+        return await make_request(bot, method)
+
+
+outbound_scheduler = OutboundScheduler(BOT_API_RATE)
+queue_depth_metric.set_function(outbound_scheduler.queue_depths)
+
+
+def install_scheduler(bot):
+    """Bot sessiyasiga rejalashtiruvchini ulash."""
+    bot.session.middleware(SchedulerMiddleware(outbound_scheduler))
+
+
+# === Bot API metrikalari ===
+
+api_requests_metric = Counter(
+    "bot_api_requests", "Bot API so'rovlari (metod va natija bo'yicha)", ("method", "result")
+)
+api_duration_metric = Histogram(
+    "bot_api_request_duration_seconds", "Bot API so'rovining bajarilish vaqti", ("method",)
+)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """So'rovlar soni va davomiyligini metod bo'yicha yozish (navbatda kutish kirmaydi)."""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", "unknown")
+        started = time.perf_counter()
+        result = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            result = "retry_after"
+            raise
+        except TelegramForbiddenError:
+            result = "forbidden"
+            raise
+        except TelegramBadRequest:
+            result = "bad_request"
+            raise
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            api_requests_metric.inc(method=api_method, result=result)
+            api_duration_metric.observe(time.perf_counter() - started, method=api_method)
+
+
+def install_api_metrics(bot):
+    """Rejalashtiruvchidan keyin ulanadi — kechroq ulangan middleware ichkarida ishlaydi."""
+    bot.session.middleware(ApiMetricsMiddleware())
@@ -0,0 +1,273 @@
+import os
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from dotenv import load_dotenv
+
+from metrics import Counter
+from webserver import create_app, start_web_server
+
+from bot_api import (
+    broadcast_limiter, call_api, CallResult, CallStatus, BROADCAST_RATE,
+    bulk_priority, install_scheduler, install_api_metrics
+)
+from database import (
+    init_db, close_db, start_db_health_checker, iter_user_ids, get_broadcast_job,
+    mark_users_blocked, claim_broadcast_chunk, save_chunk_progress,
+    release_broadcast_chunk, complete_broadcast_chunk,
+    broadcast_worker_heartbeat, remove_broadcast_worker
+)
+
+load_dotenv()
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_CHECKPOINT_SIZE = 200
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_POLL_INTERVAL = 2
+# Bo'lak shu vaqt ichida yangilanmasa, worker o'lgan deb hisoblanadi
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", "120"))
+# To'xtashda joriy partiya shuncha kutiladi, keyin bekor qilinib bo'lak navbatga qaytadi
+BROADCAST_SHUTDOWN_TIMEOUT = 10
+WORKER_HEARTBEAT_INTERVAL = 5
+WORKER_STALE_SECONDS = 15
+
+# Ixtiyoriy: worker metrikalarini alohida portda eksport qilish
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+broadcast_messages_metric = Counter(
+    "broadcast_messages", "Ommaviy yuborishda jo'natilgan xabarlar", ("result",)
+)
+
+BROADCAST_STATUS_LABELS = {
+    "running": "▶️ Yuborilmoqda",
+    "paused": "⏸ To'xtatilgan",
+    "cancelled": "⛔️ Bekor qilingan",
+    "done": "✅ Tugagan",
+}
+
+
+def broadcast_job_keyboard(job: dict) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    if job["status"] == "running":
+        builder.button(text="⏸ To'xtatish", callback_data=f"bjob:pause:{job['id']}")
+    elif job["status"] == "paused":
+        builder.button(text="▶️ Davom ettirish", callback_data=f"bjob:resume:{job['id']}")
+    if job["status"] in ("running", "paused"):
+        builder.button(text="⛔️ Bekor qilish", callback_data=f"bjob:cancel:{job['id']}")
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+def format_broadcast_job(job: dict) -> str:
+    done = job["success"] + job["fail"]
+    return (
+        f"📨 <b>Yuborish #{job['id']}</b> — {BROADCAST_STATUS_LABELS.get(job['status'], job['status'])}\n"
+        f"👥 Jami: {job['total']}\n"
+        f"✅ Yuborildi: {job['success']}\n"
+        f"❌ Xatolik: {job['fail']}\n"
+        f"⏳ Kutilmoqda: {max(job['total'] - done, 0)}"
+    )
+
+
+async def update_status_message(bot: Bot, job: dict, text: str, reply_markup=None):
+    if not job.get("status_message_id"):
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=job["admin_id"],
+            message_id=job["status_message_id"],
+            text=text,
+            parse_mode="HTML",
+            reply_markup=reply_markup
+        )
+    except Exception:
+        pass
+
+
+async def process_chunk(bot: Bot, job: dict, chunk: dict, stop_event: Optional[asyncio.Event] = None):
+    """
+    Vazifaning bitta bo'lagini yuborish (HTML parse mode bilan).
+    Har BROADCAST_CHECKPOINT_SIZE foydalanuvchidan keyin nazorat nuqtasi
+    yoziladi va admin bergan buyruq (pauza/bekor) o'qiladi.
+    Worker to'xtatilsa (stop_event yoki bekor qilish) bo'lak navbatga qaytariladi —
+    boshqa worker uni lease muddatini kutmasdan oxirgi nazorat nuqtasidan davom ettiradi.
+    """
+    try:
+        await _process_chunk(bot, job, chunk, stop_event)
+    except asyncio.CancelledError:
+        await release_broadcast_chunk(job["id"], chunk["chunk_no"], WORKER_ID)
+        raise
+
+
+async def _process_chunk(bot: Bot, job: dict, chunk: dict, stop_event: Optional[asyncio.Event]):
+    job_id = job["id"]
+    chunk_no = chunk["chunk_no"]
+    admin_id = job["admin_id"]
+
+    # Habar yuborish funksiyasi
+    if job["type"] == 'forward':
+        channel_username = job['source_chat']
+        msg_id = job['message_id']
+
+        def send_request(user_id: int):
+            return bot.forward_message(user_id, channel_username, msg_id)
+    else:
+        source_chat_id = int(job['source_chat'])
+        message_id = job['message_id']
+
+        def send_request(user_id: int):
+            return bot.copy_message(user_id, source_chat_id, message_id)
+
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    counters = {"success": 0, "fail": 0}
+    blocked = []
+
+    async def send_one(user_id: int):
+        async with semaphore:
+            result: CallResult = await call_api(
+                lambda: send_request(user_id), limiter=broadcast_limiter, chat_id=user_id
+            )
+        broadcast_messages_metric.inc(result=result.status.value)
+        if result.ok:
+            counters["success"] += 1
+        else:
+            counters["fail"] += 1
+            if result.status is CallStatus.FORBIDDEN:
+                blocked.append(user_id)
+
+    last_progress = 0.0
+    status = "running"
+    # Foydalanuvchilar bazadan partiyalab o'qiladi — ro'yxat to'liq xotiraga yuklanmaydi
+    async for batch in iter_user_ids(
+        chunk["last_user_id"], BROADCAST_CHECKPOINT_SIZE,
+        job["active_only"], job["seen_days"], until=chunk["end_id"]
+    ):
+        # Partiya to'liq tugagach nazorat nuqtasi yoziladi — hech kim tushib qolmaydi
+        # Vazifalar bulk_priority konteksti ichida yaratiladi va uni meros qilib oladi
+        with bulk_priority():
+            await asyncio.gather(*(send_one(user_id) for user_id in batch if user_id != admin_id))
+
+        # Bloklaganlar keyingi yuborishlarda "faol" auditoriyaga kirmaydi
+        if blocked:
+            await mark_users_blocked(blocked)
+            blocked.clear()
+
+        status = await save_chunk_progress(
+            job_id, chunk_no, WORKER_ID, batch[-1], counters["success"], counters["fail"]
+        )
+        counters["success"] = counters["fail"] = 0
+        if status is None:
+            logging.warning(f"Yuborish #{job_id}/{chunk_no}: bo'lak boshqa workerga o'tdi")
+            return
+        if status != "running":
+            break
+        if stop_event is not None and stop_event.is_set():
+            await release_broadcast_chunk(job_id, chunk_no, WORKER_ID)
+            return
+
+        # Progress vaqt bo'yicha yangilanadi, partiyalar soniga bog'liq emas
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            fresh = await get_broadcast_job(job_id)
+            if fresh:
+                await update_status_message(bot, fresh, format_broadcast_job(fresh), broadcast_job_keyboard(fresh))
+
+    if status != "running":
+        await release_broadcast_chunk(job_id, chunk_no, WORKER_ID)
+        fresh = await get_broadcast_job(job_id)
+        if fresh:
+            await update_status_message(bot, fresh, format_broadcast_job(fresh), broadcast_job_keyboard(fresh))
+        return
+
+    if await complete_broadcast_chunk(job_id, chunk_no, WORKER_ID):
+        fresh = await get_broadcast_job(job_id)
+        # Yakuniy hisobot (HTML bilan)
+        await update_status_message(
+            bot, fresh,
+            f"✅ <b>Yuborish tugadi!</b>\n"
+            f"Jami foydalanuvchilar: {fresh['total']}\n"
+            f"Muvaqqiyatli: {fresh['success']}\n"
+            f"Xato: {fresh['fail']}"
+        )
+
+
+async def heartbeat_loop():
+    """Umumiy tezlik (BROADCAST_RATE) tirik workerlar orasida teng bo'linadi.
+    Olingan bo'laklar muddati ham shu yerda, partiyalardan qat'i nazar uzaytiriladi."""
+    while True:
+        try:
+            workers = await broadcast_worker_heartbeat(WORKER_ID, WORKER_STALE_SECONDS)
+            broadcast_limiter.set_max_rate(BROADCAST_RATE / max(workers, 1))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Worker heartbeat xatosi: {e}")
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+
+async def run_worker(bot: Bot, stop_event: Optional[asyncio.Event] = None):
+    """Ishlayotgan vazifalardan bo'laklarni olib yuborish."""
+    stop_event = stop_event or asyncio.Event()
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
+    logging.info(f"Broadcast worker ishga tushdi: {WORKER_ID}")
+    try:
+        while not stop_event.is_set():
+            try:
+                chunk = await claim_broadcast_chunk(WORKER_ID, BROADCAST_LEASE_SECONDS)
+                if chunk is None:
+                    try:
+                        await asyncio.wait_for(stop_event.wait(), BROADCAST_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                job = await get_broadcast_job(chunk["job_id"])
+                if job:
+                    await process_chunk(bot, job, chunk, stop_event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Bo'lak muddati o'tgach boshqa worker (yoki shu worker) uni qayta oladi
+                logging.error(f"Broadcast worker xatosi: {e}")
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+    finally:
+        heartbeat_task.cancel()
+        await asyncio.gather(heartbeat_task, return_exceptions=True)
+        try:
+            await remove_broadcast_worker(WORKER_ID)
+        except Exception:
+            pass
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    await init_db()
+    start_db_health_checker()
+    bot = Bot(token=os.getenv("API_TOKEN"))
+    install_scheduler(bot)
+    install_api_metrics(bot)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = await start_web_server(create_app(), port=int(METRICS_PORT))
+    try:
+        await run_worker(bot)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await bot.session.close()
+        await close_db()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        print("Broadcast worker to'xtatildi!")
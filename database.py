@@ -1,17 +1,266 @@
 import json
+import time
+import functools
 import asyncpg
 import os
 import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from datetime import date
 from typing import Optional
 
+from metrics import Counter, Histogram
+from search_index import TrigramIndex
+
 load_dotenv()
 
 DATABASE_URL = os.environ["DATABASE_URL"]  # Majburiy
 
+# LISTEN uchun sessiya rejimidagi yoki to'g'ridan-to'g'ri ulanish kerak: transaction
+# pooler (DATABASE_URL) orqali ulanish ochiladi, lekin xabarlar kelmaydi
+DATABASE_LISTEN_URL = os.getenv("DATABASE_LISTEN_URL")
+
 db_pool: Optional[asyncpg.pool.Pool] = None
 
+MAX_USER_ID = 2 ** 63 - 1
+
+# === Katalog keshi ===
+KINO_CACHE_SIZE = int(os.getenv("KINO_CACHE_SIZE", "2000"))
+KINO_CACHE_TTL = int(os.getenv("KINO_CACHE_TTL", "600"))
+KINO_NOTIFY_CHANNEL = "kino_cache"
+
+# code -> (yozuv, amal_qilish_muddati)
+_kino_cache: "OrderedDict[str, tuple[dict, float]]" = OrderedDict()
+_kino_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+# Katalog o'zgarganda oshadi — ro'yxat sahifalari kabi hosila keshlar uchun
+_catalog_version = 0
+_listen_conn: Optional[asyncpg.Connection] = None
+
+
+def _copy_kino(data: dict) -> dict:
+    # Chaqiruvchilar ro'yxatni o'zgartirishi mumkin — keshdagi nusxa buzilmasin
+    item = dict(data)
+    item["parts_file_ids"] = list(item.get("parts_file_ids") or [])
+    return item
+
+
+def invalidate_kino_cache(code: Optional[str] = None):
+    """Faqat shu jarayondagi keshni tozalash. code berilmasa — hammasi."""
+    global _catalog_version
+    _catalog_version += 1
+    _schedule_title_refresh(code)
+    if code is None:
+        _kino_cache.clear()
+    else:
+        _kino_cache.pop(code, None)
+    _kino_cache_stats["invalidations"] += 1
+
+
+def get_catalog_version() -> int:
+    return _catalog_version
+
+
+def get_pool_stats() -> Optional[dict]:
+    if not _pool_is_usable(db_pool):
+        return None
+    return {
+        "size": db_pool.get_size(),
+        "idle": db_pool.get_idle_size(),
+        "min_size": db_pool.get_min_size(),
+        "max_size": db_pool.get_max_size(),
+    }
+
+
+def get_kino_cache_stats() -> dict:
+    hits = _kino_cache_stats["hits"]
+    misses = _kino_cache_stats["misses"]
+    total = hits + misses
+    return {
+        **_kino_cache_stats,
+        "listening": _listen_conn is not None and not _listen_conn.is_closed(),
+        "size": len(_kino_cache),
+        "hit_rate": hits / total if total else 0.0,
+    }
+
+
+async def _notify_kino_changed(conn, *codes):
+    """Boshqa bot jarayonlariga xabar berish. Tranzaksiya ichida chaqirilsa,
+    xabar commit bilan birga yetkaziladi."""
+    for code in dict.fromkeys(codes):
+        if code is None:
+            continue
+        await conn.execute("SELECT pg_notify($1, $2)", KINO_NOTIFY_CHANNEL, code)
+
+
+def _kino_changed_locally(*codes):
+    """Shu jarayondagi keshni tozalash — faqat commitdan keyin chaqiriladi,
+    aks holda parallel o'qish eski qatorni qayta keshlab qo'yishi mumkin."""
+    for code in dict.fromkeys(codes):
+        if code is not None:
+            invalidate_kino_cache(code)
+
+
+def _on_kino_notify(conn, pid, channel, payload):
+    invalidate_kino_cache(payload or None)
+
+
+def _on_listen_terminated(conn):
+    global _listen_conn
+    print("[DB] LISTEN ulanishi uzildi, kesh tozalanmoqda…")
+    _listen_conn = None
+    # Uzilish paytida kelgan xabarlar yo'qolgan bo'lishi mumkin
+    invalidate_kino_cache()
+    asyncio.get_running_loop().create_task(start_kino_listener())
+
+
+async def start_kino_listener(retries: int = 3, delay: int = 5):
+    """Boshqa jarayonlardan kelgan kesh bekor qilish xabarlarini tinglash."""
+    global _listen_conn
+    if _listen_conn is not None and not _listen_conn.is_closed():
+        return
+    if not DATABASE_LISTEN_URL:
+        print(
+            "[DB] ⚠️ DATABASE_LISTEN_URL berilmagan — boshqa jarayonlardagi katalog o'zgarishlari "
+            "kelmaydi, kesh faqat TTL bilan yangilanadi (sessiya rejimidagi URL bering)"
+        )
+        return
+    for attempt in range(retries):
+        try:
+            conn = await asyncpg.connect(
+                dsn=DATABASE_LISTEN_URL, ssl="require", statement_cache_size=0
+            )
+            await conn.add_listener(KINO_NOTIFY_CHANNEL, _on_kino_notify)
+            conn.add_termination_listener(_on_listen_terminated)
+            _listen_conn = conn
+            return
+        except Exception as e:
+            print(f"[DB] LISTEN xatosi ({attempt+1}/{retries}): {e}")
+            await asyncio.sleep(delay)
+    # LISTEN ishlamasa ham kesh TTL tufayli eskirgan ma'lumot uzoq qolmaydi
+    print("[DB] LISTEN yoqilmadi, kesh faqat TTL bilan yangilanadi")
+
+
+# === Nom bo'yicha qidiruv ===
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "20"))
+# Bazada pg_trgm bor-yo'qligi (init_db da aniqlanadi)
+_trgm_available = False
+# Asosiy yo'l — xotiradagi nomlar indeksi: ishga tushganda fonda quriladi, keyin
+# katalog o'zgarishlari (kesh bekor qilinishi bilan birga) faqat o'zgargan kodlar
+# bo'yicha yangilanadi. Indeks tayyor bo'lguncha qidiruv pg_trgm bilan bazada bajariladi
+_title_index = TrigramIndex()
+_title_index_ready = False
+_title_build_task: Optional[asyncio.Task] = None
+_title_refresh_codes: set = set()  # None — butun indeksni qayta qurish
+_title_refresh_task: Optional[asyncio.Task] = None
+_title_rebuild_task: Optional[asyncio.Task] = None
+TITLE_REFRESH_RETRY_DELAY = 5
+# Davriy to'liq qayta qurish: xabari yo'qolgan o'zgarishlar (LISTEN uzilishi) ham indeksga tushadi
+TITLE_INDEX_REBUILD_INTERVAL = int(os.getenv("TITLE_INDEX_REBUILD_INTERVAL", "3600"))
+
+
+async def _setup_title_search(conn):
+    global _trgm_available
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS kino_codes_title_trgm_idx
+            ON kino_codes USING gin (lower(title) gin_trgm_ops)
+        """)
+        _trgm_available = True
+    except asyncpg.PostgresError as e:
+        _trgm_available = False
+        print(f"[DB] pg_trgm mavjud emas ({e}), qidiruv xotiradagi indeks bilan ishlaydi")
+
+
+async def build_title_index():
+    """Katalog nomlaridan qidiruv indeksini qurish (bot ishga tushganda)."""
+    global _title_index_ready
+    async with acquire() as conn:
+        rows = await conn.fetch("SELECT code, title FROM kino_codes")
+    _title_index.build(rows)
+    _title_index_ready = True
+    print(f"[DB] Qidiruv indeksi qurildi: {len(rows)} ta nom")
+
+
+def _log_title_build_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[DB] Qidiruv indeksini qurishda xato: {task.exception()}")
+
+
+async def _build_title_index_then_refresh():
+    await build_title_index()
+    # Qurilish paytida kelgan o'zgarishlar o'qilgan ro'yxatda bo'lmasligi mumkin
+    if _title_refresh_codes:
+        _schedule_title_refresh(*_title_refresh_codes)
+
+
+def start_title_index_build() -> asyncio.Task:
+    """Indeksni bir marta qurish: bir vaqtda kelgan chaqiruvlar bitta vazifani kutadi."""
+    global _title_build_task
+    if _title_build_task is None or (_title_build_task.done() and not _title_index_ready):
+        _title_build_task = asyncio.create_task(_build_title_index_then_refresh())
+        _title_build_task.add_done_callback(_log_title_build_error)
+    return _title_build_task
+
+
+def _schedule_title_refresh(*codes: Optional[str]):
+    global _title_refresh_task
+    if not _title_index_ready:
+        if _title_build_task is not None and not _title_build_task.done():
+            _title_refresh_codes.update(codes)
+        return
+    _title_refresh_codes.update(codes)
+    if _title_refresh_task is None or _title_refresh_task.done():
+        _title_refresh_task = asyncio.get_running_loop().create_task(_refresh_titles())
+
+
+async def _refresh_titles():
+    while _title_refresh_codes:
+        codes = set(_title_refresh_codes)
+        _title_refresh_codes.clear()
+        try:
+            if None in codes:
+                await build_title_index()
+                continue
+            async with acquire() as conn:
+                rows = await conn.fetch(
+                    "SELECT code, title FROM kino_codes WHERE code = ANY($1::text[])", list(codes)
+                )
+            titles = {row["code"]: row["title"] for row in rows}
+            for code in codes:
+                if code in titles:
+                    _title_index.add(code, titles[code])
+                else:
+                    _title_index.remove(code)
+        except Exception as e:
+            print(f"[DB] Qidiruv indeksini yangilashda xato: {e}")
+            _title_refresh_codes.update(codes)
+            await asyncio.sleep(TITLE_REFRESH_RETRY_DELAY)
+
+
+async def _title_rebuild_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        # Navbatdagi yangilanishlar bilan bitta vazifada — parallel qurilish bo'lmaydi
+        _schedule_title_refresh(None)
+
+
+def start_title_index_rebuilder(interval: int = TITLE_INDEX_REBUILD_INTERVAL):
+    """Qidiruv indeksini davriy ravishda bazadan to'liq qayta qurish."""
+    global _title_rebuild_task
+    if _title_rebuild_task is None or _title_rebuild_task.done():
+        _title_rebuild_task = asyncio.create_task(_title_rebuild_loop(interval))
+    return _title_rebuild_task
+
+
+def get_title_index_stats() -> dict:
+    return {"ready": _title_index_ready, "size": len(_title_index)}
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
 
 # === Databasega ulanish ===
 async def init_db(retries: int = 5, delay: int = 2):
@@ -35,6 +284,29 @@ async def init_db(retries: int = 5, delay: int = 2):
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
                 """)
+                # Bloklagan / faol bo'lmagan foydalanuvchilarni ajratish uchun
+                await conn.execute("""
+                    ALTER TABLE users
+                        ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active',
+                        ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ;
+                """)
+                has_last_seen = await conn.fetchval("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'last_seen'
+                    )
+                """)
+                if not has_last_seen:
+                    # DEFAULT NOW() bilan qo'shilsa, eski foydalanuvchilarning hammasi
+                    # "hozir kelgan" bo'lib qolardi. Eski qatorlar uchun ma'lum bo'lgan
+                    # yagona faollik — ro'yxatdan o'tgan vaqt; DEFAULT faqat yangi qatorlarga
+                    async with conn.transaction():
+                        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ")
+                        await conn.execute("UPDATE users SET last_seen = created_at WHERE last_seen IS NULL")
+                        await conn.execute("ALTER TABLE users ALTER COLUMN last_seen SET DEFAULT NOW()")
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS users_status_last_seen_idx ON users (status, last_seen)"
+                )
 
                 # === Anime kodlari ===
                 await conn.execute("""
@@ -43,10 +315,9 @@ async def init_db(retries: int = 5, delay: int = 2):
                         title TEXT,
                         channel TEXT,
                         message_id INTEGER,
-                        post_count INTEGER,
+                        post_count INTEGER NOT NULL DEFAULT 0,
                         poster_file_id TEXT,
                         caption TEXT,
-                        parts_file_ids TEXT,
                         genre TEXT,
                         season TEXT,
                         quality TEXT,
@@ -57,6 +328,90 @@ async def init_db(retries: int = 5, delay: int = 2):
                     );
                 """)
 
+                # Raqamli kodlarni son tartibida berish uchun: avval uzunlik, keyin matn
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS kino_codes_code_order_idx ON kino_codes ((length(code)), code)"
+                )
+
+                # Nom bo'yicha noaniq qidiruv: pg_trgm bo'lmasa xotiradagi indeksga o'tiladi
+                await _setup_title_search(conn)
+
+                # === Qismlar ===
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS episodes (
+                        code TEXT NOT NULL REFERENCES kino_codes(code)
+                            ON UPDATE CASCADE ON DELETE CASCADE,
+                        part_no INTEGER NOT NULL,
+                        file_id TEXT NOT NULL,
+                        added_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                        PRIMARY KEY (code, part_no)
+                    );
+                """)
+                # post_count qismlar jadvali bilan avtomatik mos turadi.
+                # Triggerlar faqat yo'q bo'lsa yaratiladi: DROP/CREATE TRIGGER episodes ni
+                # ACCESS EXCLUSIVE bilan qulflaydi, har ishga tushish/qayta ulanishda emas.
+                # Funksiya o'zgarsa — triggerlardan birini qo'lda o'chirib, qayta ishga tushiring
+                has_post_count_triggers = await conn.fetchval("""
+                    SELECT COUNT(*) = 2 FROM pg_trigger
+                    WHERE tgrelid = 'episodes'::regclass
+                      AND tgname IN ('episodes_post_count_ins', 'episodes_post_count_del')
+                """)
+                if not has_post_count_triggers:
+                    async with conn.transaction():
+                        await conn.execute("""
+                            CREATE OR REPLACE FUNCTION episodes_post_count() RETURNS trigger AS $$
+                            BEGIN
+                                IF TG_OP = 'INSERT' THEN
+                                    UPDATE kino_codes k SET post_count = COALESCE(k.post_count, 0) + n.cnt
+                                    FROM (SELECT code, COUNT(*) AS cnt FROM changed GROUP BY code) n
+                                    WHERE k.code = n.code;
+                                ELSE
+                                    UPDATE kino_codes k SET post_count = GREATEST(COALESCE(k.post_count, 0) - n.cnt, 0)
+                                    FROM (SELECT code, COUNT(*) AS cnt FROM changed GROUP BY code) n
+                                    WHERE k.code = n.code;
+                                END IF;
+                                RETURN NULL;
+                            END
+                            $$ LANGUAGE plpgsql;
+                        """)
+                        await conn.execute("""
+                            DROP TRIGGER IF EXISTS episodes_post_count_ins ON episodes;
+                            DROP TRIGGER IF EXISTS episodes_post_count_del ON episodes;
+                            CREATE TRIGGER episodes_post_count_ins AFTER INSERT ON episodes
+                                REFERENCING NEW TABLE AS changed
+                                FOR EACH STATEMENT EXECUTE FUNCTION episodes_post_count();
+                            CREATE TRIGGER episodes_post_count_del AFTER DELETE ON episodes
+                                REFERENCING OLD TABLE AS changed
+                                FOR EACH STATEMENT EXECUTE FUNCTION episodes_post_count();
+                        """)
+
+                # Eski JSON ustunidagi qismlarni ko'chirish (bir marta: keyin ustun o'chiriladi)
+                has_legacy_parts = await conn.fetchval("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_schema = current_schema()
+                          AND table_name = 'kino_codes' AND column_name = 'parts_file_ids'
+                    )
+                """)
+                if has_legacy_parts:
+                    async with conn.transaction():
+                        migrated = await conn.execute("""
+                            INSERT INTO episodes (code, part_no, file_id)
+                            SELECT k.code, p.part_no, p.file_id
+                            FROM kino_codes k,
+                                 jsonb_array_elements_text(k.parts_file_ids::jsonb)
+                                     WITH ORDINALITY AS p(file_id, part_no)
+                            WHERE k.parts_file_ids IS NOT NULL AND k.parts_file_ids <> ''
+                            ON CONFLICT DO NOTHING
+                        """)
+                        await conn.execute("ALTER TABLE kino_codes DROP COLUMN parts_file_ids")
+                        print(f"[DB] Qismlar episodes jadvaliga ko'chirildi: {migrated}")
+                    # Trigger qo'shilishidan oldingi yozuvlar uchun bir martalik tuzatish
+                    await conn.execute("""
+                        UPDATE kino_codes k
+                        SET post_count = (SELECT COUNT(*) FROM episodes e WHERE e.code = k.code)
+                    """)
+
                 # === Statistika ===
                 await conn.execute("""
                     CREATE TABLE IF NOT EXISTS stats (
@@ -95,6 +450,77 @@ async def init_db(retries: int = 5, delay: int = 2):
                     );
                 """)
 
+                # === Xabar yuborish vazifalari (qayta ishga tushganda davom etadi) ===
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                        id SERIAL PRIMARY KEY,
+                        admin_id BIGINT NOT NULL,
+                        type TEXT NOT NULL CHECK (type IN ('forward', 'copy')),
+                        source_chat TEXT NOT NULL,
+                        message_id BIGINT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'running'
+                            CHECK (status IN ('running', 'paused', 'cancelled', 'done')),
+                        total INTEGER DEFAULT 0,
+                        last_user_id BIGINT DEFAULT 0,
+                        success INTEGER DEFAULT 0,
+                        fail INTEGER DEFAULT 0,
+                        status_message_id BIGINT,
+                        created_at TIMESTAMPTZ DEFAULT NOW(),
+                        updated_at TIMESTAMPTZ DEFAULT NOW()
+                    );
+                """)
+                await conn.execute("""
+                    ALTER TABLE broadcast_jobs
+                        ADD COLUMN IF NOT EXISTS active_only BOOLEAN NOT NULL DEFAULT FALSE,
+                        ADD COLUMN IF NOT EXISTS seen_days INTEGER;
+                """)
+
+                # === Vazifa bo'laklari: bir nechta worker parallel yuborishi uchun ===
+                # (start_id, end_id] oralig'idagi foydalanuvchilar; last_user_id — nazorat nuqtasi
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS broadcast_chunks (
+                        job_id INTEGER NOT NULL REFERENCES broadcast_jobs (id) ON DELETE CASCADE,
+                        chunk_no INTEGER NOT NULL,
+                        start_id BIGINT NOT NULL,
+                        end_id BIGINT NOT NULL,
+                        last_user_id BIGINT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending'
+                            CHECK (status IN ('pending', 'claimed', 'done')),
+                        worker_id TEXT,
+                        claimed_at TIMESTAMPTZ,
+                        PRIMARY KEY (job_id, chunk_no)
+                    );
+                """)
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS broadcast_chunks_status_idx ON broadcast_chunks (status, job_id)"
+                )
+                # Bo'laksiz yaratilgan eski vazifalar — bitta bo'lak, nazorat nuqtasidan
+                await conn.execute("""
+                    INSERT INTO broadcast_chunks (job_id, chunk_no, start_id, end_id, last_user_id)
+                    SELECT id, 1, last_user_id, $1, last_user_id FROM broadcast_jobs j
+                    WHERE status IN ('running', 'paused')
+                      AND NOT EXISTS (SELECT 1 FROM broadcast_chunks c WHERE c.job_id = j.id)
+                """, MAX_USER_ID)
+
+                # === Ishlayotgan broadcast workerlar (umumiy tezlikni bo'lish uchun) ===
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS broadcast_workers (
+                        worker_id TEXT PRIMARY KEY,
+                        heartbeat TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    );
+                """)
+
+                # FSM holatlari (FSM_STORAGE=postgres bo'lganda ishlatiladi)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS fsm_states (
+                        key TEXT PRIMARY KEY,
+                        state TEXT,
+                        data JSONB NOT NULL DEFAULT '{}'::jsonb,
+                        expires_at TIMESTAMPTZ NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at);
+                """)
+
                 # Dastlabki admin
                 default_admins = [6486825926]
                 for admin_id in default_admins:
@@ -106,131 +532,598 @@ async def init_db(retries: int = 5, delay: int = 2):
             print("[DB] Ulanish muvaffaqiyatli")
             break
         except Exception as e:
-            print(f"[DB] Ulanish xatosi ({i+1}/{retries}): {e}")
-            if i + 1 == retries:
+            print(f"[DB] Ulanish xatosi ({attempt+1}/{retries}): {e}")
+            if attempt + 1 == retries:
                 raise
             await asyncio.sleep(delay)
 
-async def get_conn() -> asyncpg.pool.Pool:
-    global db_pool
-    if db_pool is None:
-        await init_db()
-        return db_pool
-    try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("SELECT 1;")
-    except (asyncpg.InterfaceError, asyncpg.PostgresError):
+# === Ulanish holati ===
+DB_HEALTH_INTERVAL = int(os.getenv("DB_HEALTH_INTERVAL", "30"))
+DB_HEALTH_TIMEOUT = 5
+
+# Ulanish uzilganini bildiruvchi xatolar (so'rov xatolari emas).
+# OSError qo'shilmaydi: Python 3.11 da TimeoutError ham OSError — so'rov
+# commit bo'lib, javobi kechikkan bo'lishi mumkin, uni takrorlash xavfli.
+CONNECTION_ERRORS = (
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    ConnectionError,
+)
+
+_reconnect_lock = asyncio.Lock()
+_health_task: Optional[asyncio.Task] = None
+_db_closed = False
+
+
+def _pool_is_usable(pool) -> bool:
+    return pool is not None and not pool.is_closing()
+
+
+async def reconnect(stale_pool):
+    """Poolni qayta yaratish. Bir vaqtda faqat bitta qayta ulanish bajariladi:
+    kutib turganlar tayyor poolni oladi."""
+    async with _reconnect_lock:
+        if _db_closed:
+            # close_db dan keyin yangi pool ochilmaydi (u yopilmay qolib ketardi)
+            raise asyncpg.InterfaceError("baza ulanishi yopilgan")
+        if db_pool is not stale_pool and _pool_is_usable(db_pool):
+            return db_pool  # Boshqa korutina allaqachon qayta ulagan
         print("[DB] Pool uzildi, qayta ulanmoqda…")
+        if stale_pool is not None:
+            stale_pool.terminate()
         await init_db()
+        return db_pool
+
+
+async def get_conn() -> asyncpg.pool.Pool:
+    # Ping yo'q: uzilish haqiqiy so'rovda (db_retry) yoki fon tekshiruvida aniqlanadi
+    if not _pool_is_usable(db_pool):
+        return await reconnect(db_pool)
     return db_pool
 
 
-# === Foydalanuvchilar ===
-async def add_user(user_id):
+db_query_metric = Histogram(
+    "db_query_duration_seconds", "database.py funksiyalarining bajarilish vaqti", ("function",)
+)
+db_query_errors_metric = Counter(
+    "db_query_errors", "database.py funksiyalaridagi xatolar", ("function",)
+)
+db_acquire_metric = Histogram(
+    "db_pool_acquire_seconds", "Pooldan ulanish olishni kutish vaqti"
+)
+
+
+@asynccontextmanager
+async def acquire():
+    """Pooldan ulanish olish (kutish vaqti o'lchanadi)."""
     pool = await get_conn()
+    started = time.perf_counter()
     async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO users (user_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id
-        )
+        db_acquire_metric.observe(time.perf_counter() - started)
+        yield conn
 
+
+def timed(func):
+    """Funksiyaning to'liq bajarilish vaqtini (qayta urinishlar bilan) yozish."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            db_query_errors_metric.inc(function=name)
+            raise
+        finally:
+            db_query_metric.observe(time.perf_counter() - started, function=name)
+    return wrapper
+
+
+def db_retry(func):
+    """Ulanish xatosida so'rovni bir marta qayta bajarish.
+    Faqat takrorlansa zarari yo'q (idempotent) funksiyalar uchun: natijasi birinchi
+    urinish commit bo'lgan-bo'lmaganiga bog'liq yozuvlarga qo'yilmaydi."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            print(f"[DB] {func.__name__}: ulanish xatosi ({e}), qayta urinilmoqda…")
+            stale_pool = db_pool
+            if not _pool_is_usable(stale_pool):
+                await reconnect(stale_pool)
+            # Pool buzilgan ulanishni o'zi almashtiradi — qayta urinish yangi ulanishda
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+async def _health_loop(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        stale_pool = db_pool
+        try:
+            if not _pool_is_usable(stale_pool):
+                raise asyncpg.InterfaceError("pool yopilgan")
+            async with stale_pool.acquire(timeout=DB_HEALTH_TIMEOUT) as conn:
+                await conn.execute("SELECT 1;", timeout=DB_HEALTH_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except CONNECTION_ERRORS as e:
+            print(f"[DB] Holat tekshiruvi xatosi: {e}")
+            try:
+                await reconnect(stale_pool)
+            except Exception as e:
+                print(f"[DB] Qayta ulanib bo'lmadi: {e}")
+        except Exception as e:
+            # Masalan, pool band bo'lgani uchun timeout: ulanish ishlayapti,
+            # qayta ulanish barcha davom etayotgan so'rovlarni uzib yuborardi
+            print(f"[DB] Holat tekshiruvi xatosi (qayta ulanilmaydi): {e!r}")
+
+
+def start_db_health_checker(interval: int = DB_HEALTH_INTERVAL):
+    """Fon rejimida poolni vaqti-vaqti bilan tekshirish."""
+    global _health_task
+    if _health_task is None or _health_task.done():
+        _health_task = asyncio.create_task(_health_loop(interval))
+    return _health_task
+
+
+# === Foydalanuvchilar ===
+# Ma'lum foydalanuvchilar va faolligi oxirgi yozilgan kun xotirada saqlanadi —
+# bugun yozib bo'linganlar uchun bazaga murojaat yo'q. Qolganlari (yangi yoki bugun
+# birinchi marta kelganlar) navbatga yig'iladi va bitta ko'p qatorli upsert bilan yoziladi.
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "0.3"))
+# Xotira chegarasi: ~100 bayt/yozuv, 50 000 ta ≈ 5 MB. To'lganda eng uzoq
+# kelmagan foydalanuvchi chiqariladi — u uchun keyingi safar upsert bajariladi
+KNOWN_USERS_MAX = int(os.getenv("KNOWN_USERS_MAX", "50000"))
+
+# user_id -> last_seen yozilgan kun (date.toordinal()); tartib: eng eskisi boshida
+_known_users: dict[int, int] = {}
+_pending_users: set[int] = set()
+_users_task: Optional[asyncio.Task] = None
+_warm_task: Optional[asyncio.Task] = None
+
+
+def _remember_user(user_id: int, day: int):
+    _known_users.pop(user_id, None)
+    if len(_known_users) >= KNOWN_USERS_MAX:
+        del _known_users[next(iter(_known_users))]
+    _known_users[user_id] = day
+
+
+@timed
+@db_retry
+async def warm_known_users(limit: int = KNOWN_USERS_MAX):
+    """Oxirgi kelgan faol foydalanuvchilarni (KNOWN_USERS_MAX tagacha) xotiraga yuklash."""
+    async with acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT user_id, last_seen FROM users
+            WHERE status = 'active' AND last_seen IS NOT NULL
+            ORDER BY last_seen DESC
+            LIMIT $1
+        """, limit)
+    days: dict[int, int] = {}  # Bir xil kunlar bitta obyektni ulashadi
+    # Eskisidan boshlab: eng yangilari chiqarilishdan eng uzoq saqlanadi
+    for row in reversed(rows):
+        # Yuklash paytida yozilganlari ustun
+        if row["user_id"] in _known_users:
+            continue
+        if len(_known_users) >= KNOWN_USERS_MAX:
+            break
+        day = row["last_seen"].astimezone().date().toordinal()
+        _known_users[row["user_id"]] = days.setdefault(day, day)
+    print(f"[DB] {len(_known_users)} ta foydalanuvchi xotiraga yuklandi")
+
+
+async def _warm_known_users_quietly():
+    try:
+        await warm_known_users()
+    except Exception as e:
+        # Yuklanmasa ham ishlaydi: add_user shunchaki birinchi murojaatda upsert qiladi
+        print(f"[DB] Foydalanuvchilarni xotiraga yuklashda xato: {e}")
+
+
+def start_known_users_warmup():
+    """Ma'lum foydalanuvchilarni fonda yuklash — polling kutib turmaydi."""
+    global _warm_task
+    if _warm_task is None or _warm_task.done():
+        _warm_task = asyncio.create_task(_warm_known_users_quietly())
+    return _warm_task
+
+
+async def add_user(user_id):
+    """Foydalanuvchini qo'shish va faolligini (last_seen) belgilash — kuniga bir marta."""
+    if _known_users.get(user_id) == date.today().toordinal():
+        return
+    _pending_users.add(user_id)
+
+
+@timed
+async def flush_users():
+    """Navbatdagi foydalanuvchilarni bitta so'rov bilan yozish."""
+    global _pending_users
+    if not _pending_users:
+        return
+    batch, _pending_users = list(_pending_users), set()
+    try:
+        async with acquire() as conn:
+            await conn.execute("""
+                INSERT INTO users (user_id) SELECT unnest($1::bigint[])
+                ON CONFLICT (user_id) DO UPDATE SET
+                    last_seen = NOW(), status = 'active', blocked_at = NULL
+            """, batch)
+    except BaseException as e:
+        # Yozilmaganlar qaytariladi (bekor qilinganda ham)
+        _pending_users.update(batch)
+        if not isinstance(e, Exception):
+            raise
+        print(f"[DB] Foydalanuvchilarni yozishda xato: {e}")
+        return
+    today = date.today().toordinal()
+    for user_id in batch:
+        _remember_user(user_id, today)
+
+
+@timed
+@db_retry
+async def mark_users_blocked(user_ids):
+    """Botni bloklagan foydalanuvchilarni belgilash (ommaviy yuborish natijasidan)."""
+    if not user_ids:
+        return
+    for user_id in user_ids:
+        _known_users.pop(user_id, None)
+    async with acquire() as conn:
+        await conn.execute("""
+            UPDATE users SET status = 'blocked', blocked_at = NOW()
+            WHERE user_id = ANY($1::bigint[]) AND status <> 'blocked'
+        """, list(user_ids))
+
+
+@timed
+@db_retry
+async def set_user_status(user_id: int, status: str):
+    """my_chat_member yangilanishidan: 'active' yoki 'blocked'."""
+    if status not in ("active", "blocked"):
+        raise ValueError(f"Noto‘g‘ri holat: {status}")
+    _known_users.pop(user_id, None)
+    async with acquire() as conn:
+        if status == "blocked":
+            await conn.execute(
+                "UPDATE users SET status = 'blocked', blocked_at = NOW() WHERE user_id = $1", user_id
+            )
+        else:
+            await conn.execute("""
+                INSERT INTO users (user_id) VALUES ($1)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    last_seen = NOW(), status = 'active', blocked_at = NULL
+            """, user_id)
+
+
+def _audience_filter(active_only: bool = False, seen_days: Optional[int] = None, first_param: int = 1):
+    """Auditoriya sharti: (WHERE qismi, parametrlar)."""
+    conditions = []
+    args = []
+    if active_only or seen_days:
+        conditions.append("status = 'active'")
+    if seen_days:
+        args.append(seen_days)
+        conditions.append(f"last_seen >= NOW() - make_interval(days => ${first_param + len(args) - 1})")
+    return (" AND ".join(conditions) or "TRUE"), args
+
+
+@timed
+@db_retry
+async def count_users(active_only: bool = False, seen_days: Optional[int] = None) -> int:
+    where, args = _audience_filter(active_only, seen_days)
+    async with acquire() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) FROM users WHERE {where}", *args)
+
+
+async def _users_flush_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        # Bo'sh navbat vaqt metrikasiga so'rovsiz chaqiruv sifatida yozilmasin
+        if _pending_users:
+            await flush_users()
+
+
+def start_users_flusher(interval: float = USERS_FLUSH_INTERVAL):
+    global _users_task
+    if _users_task is None or _users_task.done():
+        _users_task = asyncio.create_task(_users_flush_loop(interval))
+    return _users_task
+
+@timed
+@db_retry
 async def get_user_count():
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         row = await conn.fetchrow("SELECT COUNT(*) FROM users")
         return row[0]
 
+@timed
+@db_retry
 async def get_today_users():
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         today = date.today()
         row = await conn.fetchrow("SELECT COUNT(*) FROM users WHERE DATE(created_at) = $1", today)
         return row[0] if row else 0
 
 
 # === Anime kodlari ===
+@timed
+@db_retry
 async def add_anime(code, title, poster_file_id, parts_file_ids, caption="", genre="", season="1", quality="", channel_name="", dubbed_by="", total_parts=0, poster_type="photo"):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO kino_codes (
-                code, title, poster_file_id, caption, parts_file_ids, post_count,
-                genre, season, quality, channel_name, dubbed_by, total_parts, poster_type
-            )
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
-            ON CONFLICT (code) DO UPDATE SET
-                title = EXCLUDED.title,
-                poster_file_id = EXCLUDED.poster_file_id,
-                caption = EXCLUDED.caption,
-                parts_file_ids = EXCLUDED.parts_file_ids,
-                genre = EXCLUDED.genre,
-                season = EXCLUDED.season,
-                quality = EXCLUDED.quality,
-                channel_name = EXCLUDED.channel_name,
-                dubbed_by = EXCLUDED.dubbed_by,
-                total_parts = EXCLUDED.total_parts,
-                poster_type = EXCLUDED.poster_type;
-        """, code, title, poster_file_id, caption, json.dumps(parts_file_ids), len(parts_file_ids),
-           genre, season, quality, channel_name, dubbed_by, total_parts, poster_type)
-        await conn.execute("INSERT INTO stats (code) VALUES ($1) ON CONFLICT DO NOTHING", code)
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO kino_codes (
+                    code, title, poster_file_id, caption,
+                    genre, season, quality, channel_name, dubbed_by, total_parts, poster_type
+                )
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+                ON CONFLICT (code) DO UPDATE SET
+                    title = EXCLUDED.title,
+                    poster_file_id = EXCLUDED.poster_file_id,
+                    caption = EXCLUDED.caption,
+                    genre = EXCLUDED.genre,
+                    season = EXCLUDED.season,
+                    quality = EXCLUDED.quality,
+                    channel_name = EXCLUDED.channel_name,
+                    dubbed_by = EXCLUDED.dubbed_by,
+                    total_parts = EXCLUDED.total_parts,
+                    poster_type = EXCLUDED.poster_type;
+            """, code, title, poster_file_id, caption,
+               genre, season, quality, channel_name, dubbed_by, total_parts, poster_type)
+            # Qayta qo'shilganda qismlar ro'yxati to'liq almashtiriladi (post_count trigger orqali)
+            await conn.execute("DELETE FROM episodes WHERE code = $1", code)
+            await _insert_episodes(conn, code, parts_file_ids, first_part=1)
+            await conn.execute("INSERT INTO stats (code) VALUES ($1) ON CONFLICT DO NOTHING", code)
+            await _notify_kino_changed(conn, code)
+    _kino_changed_locally(code)
+
+
+KINO_COLUMNS = """
+    code, title, poster_file_id, caption,
+    ARRAY(
+        SELECT e.file_id FROM episodes e WHERE e.code = kino_codes.code ORDER BY e.part_no
+    ) AS parts_file_ids,
+    post_count, channel, message_id, genre, season, quality,
+    channel_name, dubbed_by, total_parts, poster_type
+"""
+
+
+def _kino_cache_get(code) -> Optional[dict]:
+    entry = _kino_cache.get(code)
+    if entry is not None and entry[1] > time.monotonic():
+        _kino_cache.move_to_end(code)
+        _kino_cache_stats["hits"] += 1
+        return entry[0]
+    _kino_cache_stats["misses"] += 1
+    return None
+
+
+def _kino_cache_put(code, data: dict, version: int):
+    """:param version: O'qish boshlangandagi katalog versiyasi — o'qish paytida
+    katalog o'zgargan bo'lsa, eskirgan bo'lishi mumkin bo'lgan yozuv saqlanmaydi"""
+    if version != _catalog_version:
+        return
+    _kino_cache[code] = (data, time.monotonic() + KINO_CACHE_TTL)
+    _kino_cache.move_to_end(code)
+    while len(_kino_cache) > KINO_CACHE_SIZE:
+        _kino_cache.popitem(last=False)
+
 
+def _decode_kino(row) -> dict:
+    data = dict(row)
+    data["parts_file_ids"] = list(data["parts_file_ids"] or [])
+    return data
 
+
+@timed
+@db_retry
 async def get_kino_by_code(code):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT code, title, poster_file_id, caption, parts_file_ids,
-                   post_count, channel, message_id, genre, season, quality,
-                   channel_name, dubbed_by, total_parts, poster_type
+    cached = _kino_cache_get(code)
+    if cached is not None:
+        return _copy_kino(cached)
+
+    version = _catalog_version
+    async with acquire() as conn:
+        row = await conn.fetchrow(f"""
+            SELECT {KINO_COLUMNS}
             FROM kino_codes
             WHERE code = $1
         """, code)
-        if row:
-            data = dict(row)
-            data["parts_file_ids"] = json.loads(data["parts_file_ids"]) if data.get("parts_file_ids") else []
-            return data
+    if not row:
         return None
+    data = _decode_kino(row)
+    _kino_cache_put(code, data, version)
+    return _copy_kino(data)
 
 
-async def get_all_codes():
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM kino_codes")
-        result = []
-        for row in rows:
-            item = dict(row)
-            item["parts_file_ids"] = json.loads(item["parts_file_ids"]) if item.get("parts_file_ids") else []
-            result.append(item)
-        return result
+# Ro'yxat tartiblari: "code" — kodlar son tartibida (indeks bilan), "title" — nom bo'yicha
+CODE_TITLE_ORDERS = {
+    "code": "length(code), code",
+    "title": "lower(title), code",
+}
 
 
+@timed
+@db_retry
+async def list_code_titles(order: str = "code", offset: int = 0, limit: int = 100) -> list[dict]:
+    """Faqat kod va nom — bitta sahifa uchun (qismlar o'qilmaydi)."""
+    order_by = CODE_TITLE_ORDERS[order]
+    async with acquire() as conn:
+        rows = await conn.fetch(f"""
+            SELECT code, title FROM kino_codes
+            ORDER BY {order_by}
+            OFFSET $1 LIMIT $2
+        """, offset, limit)
+    return [dict(row) for row in rows]
+
+
+@timed
+@db_retry
+async def count_codes() -> int:
+    async with acquire() as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM kino_codes")
+
+
+@timed
 async def delete_kino_code(code):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
+        _pending_stats.pop(code, None)
         await conn.execute("DELETE FROM stats WHERE code = $1", code)
         result = await conn.execute("DELETE FROM kino_codes WHERE code = $1", code)
-        return result.endswith("1")
+        await _notify_kino_changed(conn, code)
+    _kino_changed_locally(code)
+    return result.endswith("1")
 
 
 # === Statistika ===
+# Hisoblagichlar xotirada yig'iladi va har STATS_FLUSH_INTERVAL soniyada bitta
+# so'rov bilan yoziladi — bitta mashhur kod qatori uchun raqobat bo'lmaydi.
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+
+# code -> [searched, viewed] (hali bazaga yozilmagan qism)
+_pending_stats: dict[str, list[int]] = {}
+_stats_task: Optional[asyncio.Task] = None
+
+
+def _buffer_stat(code, searched: int, viewed: int):
+    if not searched and not viewed:
+        return
+    counters = _pending_stats.setdefault(code, [0, 0])
+    counters[0] += searched
+    counters[1] += viewed
+
+
 async def increment_stat(code, field):
     if field not in ("searched", "viewed", "init"):
         return
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        if field == "init":
-            await conn.execute("INSERT INTO stats (code, searched, viewed) VALUES ($1, 0, 0) ON CONFLICT DO NOTHING", code)
-        else:
-            await conn.execute(f"UPDATE stats SET {field} = {field} + 1 WHERE code = $1", code)
+    # "init" alohida kerak emas: yozishda qator yo'q bo'lsa yaratiladi
+    _buffer_stat(code, int(field == "searched"), int(field == "viewed"))
 
 
+@timed
+async def flush_stats():
+    """Yig'ilgan hisoblagichlarni bitta so'rov bilan bazaga yozish."""
+    global _pending_stats
+    if not _pending_stats:
+        return
+    batch, _pending_stats = _pending_stats, {}
+    # Tartiblangan kodlar — bir nechta jarayon bir vaqtda yozganda deadlock bo'lmasin
+    codes = sorted(batch)
+    try:
+        async with acquire() as conn:
+            await conn.execute("""
+                INSERT INTO stats (code, searched, viewed)
+                SELECT v.code, v.searched, v.viewed
+                FROM unnest($1::text[], $2::int[], $3::int[]) AS v(code, searched, viewed)
+                ON CONFLICT (code) DO UPDATE SET
+                    searched = stats.searched + EXCLUDED.searched,
+                    viewed = stats.viewed + EXCLUDED.viewed
+            """, codes, [batch[c][0] for c in codes], [batch[c][1] for c in codes])
+    except BaseException as e:
+        # Yozilmagan hisoblagichlar yo'qolmasin (bekor qilinganda ham) — keyingi urinishga qaytariladi
+        for code, (searched, viewed) in batch.items():
+            _buffer_stat(code, searched, viewed)
+        if not isinstance(e, Exception):
+            raise
+        print(f"[DB] Statistikani yozishda xato: {e}")
+
+
+async def _stats_flush_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        if _pending_stats:
+            await flush_stats()
+
+
+def start_stats_flusher(interval: float = STATS_FLUSH_INTERVAL):
+    global _stats_task
+    if _stats_task is None or _stats_task.done():
+        _stats_task = asyncio.create_task(_stats_flush_loop(interval))
+    return _stats_task
+
+
+@timed
+@db_retry
 async def get_code_stat(code):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        return await conn.fetchrow("SELECT searched, viewed FROM stats WHERE code = $1", code)
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT searched, viewed FROM stats WHERE code = $1", code)
+    pending = _pending_stats.get(code)
+    if not row and not pending:
+        return None
+    searched, viewed = (row["searched"], row["viewed"]) if row else (0, 0)
+    if pending:
+        searched += pending[0]
+        viewed += pending[1]
+    return {"searched": searched, "viewed": viewed}
+
+
+@timed
+@db_retry
+async def lookup_and_count(code, fields=("searched", "viewed")):
+    """Kod bo'yicha anime yozuvini va ko'rishlar sonini bitta so'rovda olish.
+    Hisoblagichlar buferga yoziladi.
+
+    :param fields: Oshiriladigan hisoblagichlar ("searched", "viewed")
+    :return: (yozuv yoki None, ko'rishlar soni)
+    """
+    cached = _kino_cache_get(code)
+    version = _catalog_version
+
+    async with acquire() as conn:
+        if cached is not None:
+            # Yozuv keshda — faqat statistika o'qiladi
+            view_count = await conn.fetchval("SELECT viewed FROM stats WHERE code = $1", code)
+            data = cached
+        else:
+            row = await conn.fetchrow(f"""
+                SELECT {KINO_COLUMNS}, stats.viewed AS view_count
+                FROM kino_codes LEFT JOIN stats USING (code)
+                WHERE code = $1
+            """, code)
+            if not row:
+                return None, 0
+            data = _decode_kino(row)
+            view_count = data.pop("view_count")
+            _kino_cache_put(code, data, version)
+
+    # Statistika faqat mavjud kodlar uchun yoziladi
+    _buffer_stat(code, int("searched" in fields), int("viewed" in fields))
+    pending = _pending_stats.get(code)
+    view_count = (view_count or 0) + (pending[1] if pending else 0)
+    return _copy_kino(data), view_count
+
+
+async def close_db():
+    """To'xtashdan oldin buferlarni yozish va ulanishlarni yopish."""
+    global db_pool, _listen_conn, _db_closed
+    tasks = [t for t in (
+        _stats_task, _users_task, _warm_task, _health_task,
+        _title_build_task, _title_refresh_task, _title_rebuild_task
+    ) if t is not None]
+    for task in tasks:
+        task.cancel()
+    # Fon yozuvi to'xtaguncha kutiladi — bekor qilingan partiya buferga qaytadi
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await flush_users()
+    await flush_stats()
+    _db_closed = True
+    if _listen_conn is not None:
+        listen_conn, _listen_conn = _listen_conn, None
+        listen_conn.remove_termination_listener(_on_listen_terminated)
+        await listen_conn.close()
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
 
 
 # === Kodni yangilash ===
 
+@timed
 async def update_anime_code(old_code, new_code=None, new_title=None, **kwargs):
     """
     Anime kodini yangilash.
@@ -242,7 +1135,7 @@ async def update_anime_code(old_code, new_code=None, new_title=None, **kwargs):
     """
     allowed_fields = {
         'title', 'genre', 'season', 'quality',
-        'channel_name', 'dubbed_by', 'total_parts', 'parts_file_ids', 'poster_type'
+        'channel_name', 'dubbed_by', 'total_parts', 'poster_type'
     }
 
     # title ni kwargs dan ajratib olish — dublikatni oldini oladi
@@ -271,8 +1164,6 @@ async def update_anime_code(old_code, new_code=None, new_title=None, **kwargs):
     for key, value in kwargs.items():
         if key not in allowed_fields:
             raise ValueError(f"Ruxsat etilmagan maydon: {key}")
-        if key == 'parts_file_ids':
-            value = json.dumps(value)
         param_index = len(values) + 1
         set_parts.append(f"{key} = ${param_index}")
         values.append(value)
@@ -285,78 +1176,290 @@ async def update_anime_code(old_code, new_code=None, new_title=None, **kwargs):
     query = f"UPDATE kino_codes SET {', '.join(set_parts)} WHERE code = ${where_param_index}"
     values.append(old_code)
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(query, *values)
+        await _notify_kino_changed(conn, old_code, new_code)
+    _kino_changed_locally(old_code, new_code)
 
 # === Adminlar ===
+@timed
+@db_retry
 async def get_all_admins():
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT user_id FROM admins")
         return {row["user_id"] for row in rows}
 
+@timed
+@db_retry
 async def add_admin(user_id: int):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("INSERT INTO admins (user_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
 
+@timed
+@db_retry
 async def remove_admin(user_id: int):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("DELETE FROM admins WHERE user_id = $1", user_id)
 
 
 # === Foydalanuvchilar ID si ===
-async def get_all_user_ids():
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM users")
+@timed
+@db_retry
+async def get_all_user_ids(active_only: bool = False, seen_days: Optional[int] = None):
+    where, args = _audience_filter(active_only, seen_days)
+    async with acquire() as conn:
+        rows = await conn.fetch(f"SELECT user_id FROM users WHERE {where} ORDER BY user_id", *args)
         return [row["user_id"] for row in rows]
 
 
+
+async def iter_user_ids(
+    after: int = 0, batch_size: int = 1000,
+    active_only: bool = False, seen_days: Optional[int] = None,
+    until: int = MAX_USER_ID
+):
+    """Foydalanuvchi ID larini user_id tartibida partiyalab berish (keyset pagination).
+    Har partiya alohida qisqa so'rov — ulanish partiyalar orasida band qilinmaydi.
+
+    :param after: Shu ID dan keyingilar (o'zi kirmaydi)
+    :param until: Shu ID gacha (o'zi ham kiradi)
+    """
+    where, args = _audience_filter(active_only, seen_days, first_param=4)
+    query = f"""
+        SELECT user_id FROM users
+        WHERE user_id > $1 AND user_id <= $3 AND {where}
+        ORDER BY user_id
+        LIMIT $2
+    """
+    last_id = after
+    while True:
+        started = time.perf_counter()
+        async with acquire() as conn:
+            rows = await conn.fetch(query, last_id, batch_size, until, *args)
+        db_query_metric.observe(time.perf_counter() - started, function="iter_user_ids")
+        if not rows:
+            return
+        batch = [row["user_id"] for row in rows]
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1]
+
+# === Xabar yuborish vazifalari ===
+BROADCAST_JOB_COLUMNS = """
+    id, admin_id, type, source_chat, message_id, status, total,
+    last_user_id, success, fail, status_message_id, created_at, updated_at,
+    active_only, seen_days
+"""
+
+# Holat o'zgarishi: yangi holat -> qaysi holatlardan o'tish mumkin
+BROADCAST_TRANSITIONS = {
+    "paused": ("running",),
+    "running": ("paused",),
+    "cancelled": ("running", "paused"),
+    "done": ("running",),
+}
+
+
+@timed
+async def create_broadcast_job(
+    admin_id: int, btype: str, source_chat, message_id: int, total: int,
+    active_only: bool = False, seen_days: Optional[int] = None,
+    status_message_id: Optional[int] = None, chunk_size: int = 5000
+) -> int:
+    """Vazifani yaratish va foydalanuvchilarni chunk_size tadan bo'laklarga ajratish."""
+    where, args = _audience_filter(active_only, seen_days, first_param=4)
+    async with acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval("""
+                INSERT INTO broadcast_jobs (
+                    admin_id, type, source_chat, message_id, total,
+                    active_only, seen_days, status_message_id
+                )
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                RETURNING id
+            """, admin_id, btype, str(source_chat), message_id, total,
+               active_only, seen_days, status_message_id)
+            # Har chunk_size-chi foydalanuvchi bo'lak chegarasi; oxirgisi ochiq qoladi
+            await conn.execute(f"""
+                WITH bounds AS (
+                    SELECT user_id AS end_id FROM (
+                        SELECT user_id, row_number() OVER (ORDER BY user_id) AS rn
+                        FROM users WHERE {where}
+                    ) t
+                    WHERE rn % $2 = 0
+                    UNION ALL SELECT $3::bigint
+                ), ranges AS (
+                    SELECT end_id,
+                           COALESCE(lag(end_id) OVER (ORDER BY end_id), 0) AS start_id,
+                           row_number() OVER (ORDER BY end_id) AS chunk_no
+                    FROM bounds
+                )
+                INSERT INTO broadcast_chunks (job_id, chunk_no, start_id, end_id, last_user_id)
+                SELECT $1, chunk_no, start_id, end_id, start_id FROM ranges
+            """, job_id, chunk_size, MAX_USER_ID, *args)
+            return job_id
+
+
+@timed
+@db_retry
+async def get_broadcast_job(job_id: int):
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE id = $1", job_id
+        )
+        return dict(row) if row else None
+
+
+@timed
+@db_retry
+async def get_broadcast_jobs(statuses=None, limit: int = 10):
+    async with acquire() as conn:
+        if statuses:
+            rows = await conn.fetch(f"""
+                SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs
+                WHERE status = ANY($1::text[])
+                ORDER BY id DESC LIMIT $2
+            """, list(statuses), limit)
+        else:
+            rows = await conn.fetch(
+                f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs ORDER BY id DESC LIMIT $1", limit
+            )
+        return [dict(r) for r in rows]
+
+
+@timed
+async def set_broadcast_status(job_id: int, status: str) -> bool:
+    """Vazifa holatini o'zgartirish. O'tish ruxsat etilmagan bo'lsa False."""
+    allowed_from = BROADCAST_TRANSITIONS.get(status)
+    if not allowed_from:
+        raise ValueError(f"Noto‘g‘ri holat: {status}")
+    async with acquire() as conn:
+        result = await conn.execute("""
+            UPDATE broadcast_jobs SET status = $2, updated_at = NOW()
+            WHERE id = $1 AND status = ANY($3::text[])
+        """, job_id, status, list(allowed_from))
+        return result.endswith("1")
+
+
 # === Qismlar ===
+async def _insert_episodes(conn, code: str, file_ids, first_part: int):
+    await conn.execute("""
+        INSERT INTO episodes (code, part_no, file_id)
+        SELECT $1, $2 + p.ord - 1, p.file_id
+        FROM unnest($3::text[]) WITH ORDINALITY AS p(file_id, ord)
+    """, code, first_part, list(file_ids))
+
+
+async def _lock_anime(conn, code: str) -> bool:
+    # Bir animening qismlarini bir vaqtda faqat bitta tranzaksiya o'zgartiradi
+    return await conn.fetchval(
+        "SELECT TRUE FROM kino_codes WHERE code = $1 FOR UPDATE", code
+    ) is not None
+
+
+@timed
+async def add_parts_to_anime(code: str, file_ids) -> Optional[int]:
+    """Qismlarni oxiriga qo'shish.
+
+    :return: Qismlarning yangi soni yoki None (anime topilmasa)
+    """
+    async with acquire() as conn:
+        async with conn.transaction():
+            if not await _lock_anime(conn, code):
+                return None
+            last_part = await conn.fetchval(
+                "SELECT COALESCE(MAX(part_no), 0) FROM episodes WHERE code = $1", code
+            )
+            await _insert_episodes(conn, code, file_ids, first_part=last_part + 1)
+            await _notify_kino_changed(conn, code)
+    _kino_changed_locally(code)
+    return last_part + len(file_ids)
+
+
 async def add_part_to_anime(code: str, file_id: str):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT parts_file_ids FROM kino_codes WHERE code=$1", code)
-        parts = json.loads(row["parts_file_ids"]) if row and row["parts_file_ids"] else []
-        parts.append(file_id)
-        await conn.execute(
-            "UPDATE kino_codes SET parts_file_ids=$1, post_count=$2 WHERE code=$3",
-            json.dumps(parts), len(parts), code
-        )
+    return await add_parts_to_anime(code, [file_id])
 
+
+@timed
 async def delete_part_from_anime(code: str, part_number: int):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT parts_file_ids FROM kino_codes WHERE code=$1", code)
-        if not row or not row["parts_file_ids"]:
-            return False
-        parts = json.loads(row["parts_file_ids"])
-        if not (1 <= part_number <= len(parts)):
-            return False
-        parts.pop(part_number - 1)
-        await conn.execute(
-            "UPDATE kino_codes SET parts_file_ids=$1, post_count=$2 WHERE code=$3",
-            json.dumps(parts), len(parts), code
-        )
-        return True
+    """Qismni o'chirib, keyingilarini bittaga surish."""
+    async with acquire() as conn:
+        async with conn.transaction():
+            if not await _lock_anime(conn, code):
+                return False
+            deleted = await conn.fetchval(
+                "DELETE FROM episodes WHERE code = $1 AND part_no = $2 RETURNING part_no",
+                code, part_number
+            )
+            if deleted is None:
+                return False
+            # Kalit to'qnashmasligi uchun avval manfiyga, keyin joyiga o'tkaziladi
+            await conn.execute("""
+                UPDATE episodes SET part_no = -(part_no - 1)
+                WHERE code = $1 AND part_no > $2
+            """, code, part_number)
+            await conn.execute(
+                "UPDATE episodes SET part_no = -part_no WHERE code = $1 AND part_no < 0", code
+            )
+            await _notify_kino_changed(conn, code)
+    _kino_changed_locally(code)
+    return True
+
+
+@timed
+@db_retry
+async def get_episode(code: str, part_number: int):
+    """Bitta qism: {"title", "file_id"} yoki None."""
+    cached = _kino_cache_get(code)
+    if cached is not None:
+        parts = cached["parts_file_ids"]
+        if 1 <= part_number <= len(parts):
+            return {"title": cached["title"], "file_id": parts[part_number - 1]}
+        return None
+    async with acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT k.title, e.file_id
+            FROM episodes e JOIN kino_codes k USING (code)
+            WHERE e.code = $1 AND e.part_no = $2
+        """, code, part_number)
+    return dict(row) if row else None
 
 
 # === Qidiruv ===
-async def search_anime_by_title(query: str):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+async def search_anime_by_title(query: str, limit: int = SEARCH_LIMIT):
+    """Nom bo'yicha o'xshashlik tartibida qidirish (xatoli yozilgan nomlar ham topiladi).
+    Indeks qurilgan bo'lsa bazaga murojaat qilinmaydi; lotin/kirill va tutuq
+    belgisi farqlari e'tiborga olinmaydi."""
+    if _title_index_ready:
+        return _title_index.search(query, limit)
+    build = start_title_index_build()
+    if _trgm_available:
+        return await _search_titles_trgm(query, limit)
+    # pg_trgm yo'q: hamma so'rovlar bitta qurilishni kutadi
+    await asyncio.shield(build)
+    return _title_index.search(query, limit)
+
+
+@timed
+@db_retry
+async def _search_titles_trgm(query: str, limit: int):
+    """Indeks hali qurilmaganda: pg_trgm bilan bazada qidirish."""
+    normalized = query.strip().lower()
+    async with acquire() as conn:
+        # Ikkala shart ham trigram GIN indeksidan foydalanadi
         rows = await conn.fetch("""
             SELECT code, title FROM kino_codes
-            WHERE LOWER(title) LIKE LOWER($1)
-            ORDER BY title
-            LIMIT 20
-        """, f"%{query}%")
+            WHERE lower(title) LIKE $2 OR $1 <% lower(title)
+            ORDER BY lower(title) LIKE $2 DESC, word_similarity($1, lower(title)) DESC, title
+            LIMIT $3
+        """, normalized, f"%{_escape_like(normalized)}%", limit)
         return [{"code": r["code"], "title": r["title"]} for r in rows]
 
 
 # === ⬇️ Kanallar — SO'ROVLILI TIZIM UCHUN YANGILANGAN ===
+@timed
+@db_retry
 async def add_channel(cid: int, link: str, title: str, ctype: str, mode: str = "ochiq"):
     if not ctype:
         raise ValueError("Kanal turi topilmadi")
@@ -366,8 +1469,7 @@ async def add_channel(cid: int, link: str, title: str, ctype: str, mode: str = "
     if ctype not in ("sub", "main"):
         raise ValueError(f"Noto‘g‘ri type: {ctype}")
 
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("""
             INSERT INTO channels (channel_id, link, title, type, mode)
             VALUES ($1, $2, $3, $4, $5)
@@ -375,20 +1477,22 @@ async def add_channel(cid: int, link: str, title: str, ctype: str, mode: str = "
             DO UPDATE SET link = $2, title = $3, mode = $5
         """, cid, link, title, ctype, mode)
 
+@timed
+@db_retry
 async def remove_channel(cid: int, ctype: str = None):
     """Agar ctype berilsa — faqat shu turdagi kanal o'chiriladi.
        Agar berilmasa — ikkala turi ham o'chiriladi."""
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         if ctype:
             await conn.execute("DELETE FROM channels WHERE channel_id = $1 AND type = $2", cid, ctype)
         else:
             await conn.execute("DELETE FROM channels WHERE channel_id = $1", cid)
 
 
+@timed
+@db_retry
 async def get_channels(channel_type: str):
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch(
             "SELECT channel_id, title, link, mode FROM channels WHERE type = $1",
             channel_type
@@ -404,10 +1508,11 @@ async def get_channels(channel_type: str):
         ]
 
 
+@timed
+@db_retry
 async def add_join_request(user_id: int, channel_id: int):
     """Foydalanuvchi kanalga so'rov yuborganida chaqiriladi."""
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("""
             INSERT INTO join_requests (user_id, channel_id)
             VALUES ($1, $2)
@@ -415,12 +1520,212 @@ async def add_join_request(user_id: int, channel_id: int):
         """, user_id, channel_id)
 
 
+@timed
+@db_retry
 async def check_user_request(user_id: int, channel_id: int) -> bool:
     """Foydalanuvchi ushbu kanalga so'rov yuborganmi?"""
-    pool = await get_conn()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         row = await conn.fetchrow(
             "SELECT 1 FROM join_requests WHERE user_id = $1 AND channel_id = $2",
             user_id, channel_id
         )
         return row is not None
+
+
+@timed
+@db_retry
+async def check_user_requests(user_id: int, channel_ids: list[int]) -> set[int]:
+    """Foydalanuvchi so'rov yuborgan kanallar (berilganlar ichidan)."""
+    if not channel_ids:
+        return set()
+    async with acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT channel_id FROM join_requests WHERE user_id = $1 AND channel_id = ANY($2::bigint[])",
+            user_id, channel_ids
+        )
+        return {r["channel_id"] for r in rows}
+
+
+@timed
+@db_retry
+async def count_pending_broadcasts() -> int:
+    async with acquire() as conn:
+        return await conn.fetchval(
+            "SELECT COUNT(*) FROM broadcast_jobs WHERE status IN ('running', 'paused')"
+        )
+
+
+@timed
+async def claim_broadcast_chunk(worker_id: str, lease_seconds: int):
+    """Ishlayotgan vazifadan bitta bo'lakni olish. Boshqa worker olgan qatorlar
+    o'tkazib yuboriladi (SKIP LOCKED); muddati o'tgan (worker o'lgan) bo'laklar qayta olinadi."""
+    async with acquire() as conn:
+        row = await conn.fetchrow("""
+            UPDATE broadcast_chunks c
+            SET status = 'claimed', worker_id = $1, claimed_at = NOW()
+            FROM (
+                SELECT c2.job_id, c2.chunk_no
+                FROM broadcast_chunks c2
+                JOIN broadcast_jobs j ON j.id = c2.job_id
+                WHERE j.status = 'running'
+                  AND (c2.status = 'pending'
+                       OR (c2.status = 'claimed' AND c2.claimed_at < NOW() - make_interval(secs => $2)))
+                ORDER BY c2.job_id, c2.chunk_no
+                LIMIT 1
+                FOR UPDATE OF c2 SKIP LOCKED
+            ) s
+            WHERE c.job_id = s.job_id AND c.chunk_no = s.chunk_no
+            RETURNING c.job_id, c.chunk_no, c.start_id, c.end_id, c.last_user_id
+        """, worker_id, lease_seconds)
+        return dict(row) if row else None
+
+
+@timed
+async def save_chunk_progress(
+    job_id: int, chunk_no: int, worker_id: str, last_user_id: int, success: int, fail: int
+) -> Optional[str]:
+    """Bo'lak nazorat nuqtasi va vazifa hisoblagichlarini bitta so'rovda yangilash.
+
+    :param success: Oxirgi nazorat nuqtasidan beri muvaffaqiyatlilar soni
+    :param fail: Oxirgi nazorat nuqtasidan beri xatolar soni
+    :return: Vazifa holati yoki None (bo'lak boshqa workerga o'tib ketgan)
+    """
+    async with acquire() as conn:
+        return await conn.fetchval("""
+            WITH c AS (
+                UPDATE broadcast_chunks
+                SET last_user_id = $4, claimed_at = NOW()
+                WHERE job_id = $1 AND chunk_no = $2 AND worker_id = $3 AND status = 'claimed'
+                RETURNING job_id
+            )
+            UPDATE broadcast_jobs j
+            SET success = j.success + $5, fail = j.fail + $6, updated_at = NOW()
+            FROM c
+            WHERE j.id = c.job_id
+            RETURNING j.status
+        """, job_id, chunk_no, worker_id, last_user_id, success, fail)
+
+
+@timed
+@db_retry
+async def release_broadcast_chunk(job_id: int, chunk_no: int, worker_id: str):
+    """Vazifa to'xtatilganda bo'lakni navbatga qaytarish."""
+    async with acquire() as conn:
+        await conn.execute("""
+            UPDATE broadcast_chunks SET status = 'pending', worker_id = NULL
+            WHERE job_id = $1 AND chunk_no = $2 AND worker_id = $3 AND status = 'claimed'
+        """, job_id, chunk_no, worker_id)
+
+
+@timed
+async def complete_broadcast_chunk(job_id: int, chunk_no: int, worker_id: str) -> bool:
+    """Bo'lakni tugatish. Bu oxirgi bo'lak bo'lsa vazifa 'done' bo'ladi va True qaytadi
+    (yakuniy hisobotni faqat bitta worker yuboradi)."""
+    async with acquire() as conn:
+        await conn.execute("""
+            UPDATE broadcast_chunks SET status = 'done'
+            WHERE job_id = $1 AND chunk_no = $2 AND worker_id = $3
+        """, job_id, chunk_no, worker_id)
+        finished = await conn.fetchval("""
+            UPDATE broadcast_jobs SET status = 'done', updated_at = NOW()
+            WHERE id = $1 AND status = 'running'
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_chunks WHERE job_id = $1 AND status <> 'done'
+              )
+            RETURNING id
+        """, job_id)
+        return finished is not None
+
+
+@timed
+@db_retry
+async def broadcast_worker_heartbeat(worker_id: str, stale_seconds: int) -> int:
+    """Worker tirikligini belgilash va olgan bo'laklari muddatini uzaytirish
+    (sekin partiya lease'dan uzoq davom etsa ham bo'lak boshqa workerga o'tmaydi).
+    Qaytaradi: hozir ishlayotgan workerlar soni."""
+    async with acquire() as conn:
+        await conn.execute("""
+            INSERT INTO broadcast_workers (worker_id, heartbeat) VALUES ($1, NOW())
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat = NOW()
+        """, worker_id)
+        await conn.execute("""
+            UPDATE broadcast_chunks SET claimed_at = NOW()
+            WHERE worker_id = $1 AND status = 'claimed'
+        """, worker_id)
+        return await conn.fetchval(
+            "SELECT COUNT(*) FROM broadcast_workers WHERE heartbeat > NOW() - make_interval(secs => $1)",
+            stale_seconds
+        )
+
+
+@timed
+@db_retry
+async def count_live_broadcast_workers(stale_seconds: int) -> int:
+    async with acquire() as conn:
+        return await conn.fetchval(
+            "SELECT COUNT(*) FROM broadcast_workers WHERE heartbeat > NOW() - make_interval(secs => $1)",
+            stale_seconds
+        )
+
+
+@timed
+@db_retry
+async def remove_broadcast_worker(worker_id: str):
+    async with acquire() as conn:
+        await conn.execute("DELETE FROM broadcast_workers WHERE worker_id = $1", worker_id)
+
+
+# === FSM holatlari ===
+
+@timed
+@db_retry
+async def get_fsm_record(key: str):
+    """Muddati o'tmagan FSM yozuvi: (state, data) yoki None."""
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT state, data FROM fsm_states WHERE key = $1 AND expires_at > NOW()", key
+        )
+    if not row:
+        return None
+    return row["state"], json.loads(row["data"])
+
+
+@timed
+async def save_fsm_records(records, ttl_seconds: int):
+    """FSM yozuvlarini bitta so'rov bilan saqlash.
+
+    :param records: [(key, state_o'zgardimi, state, data_json yoki None)] —
+        o'zgarmagan maydon bazadagi qiymatini saqlaydi
+    """
+    records = sorted(records)  # Jarayonlar orasida deadlock bo'lmasin
+    keys = [r[0] for r in records]
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO fsm_states AS f (key, state, data, expires_at)
+                SELECT u.key,
+                       CASE WHEN u.set_state THEN u.state ELSE cur.state END,
+                       COALESCE(u.data::jsonb, cur.data, '{}'::jsonb),
+                       NOW() + $5 * INTERVAL '1 second'
+                FROM unnest($1::text[], $2::bool[], $3::text[], $4::text[])
+                     AS u(key, set_state, state, data)
+                LEFT JOIN fsm_states cur ON cur.key = u.key AND cur.expires_at > NOW()
+                ON CONFLICT (key) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    data = EXCLUDED.data,
+                    expires_at = EXCLUDED.expires_at
+            """, keys, [r[1] for r in records], [r[2] for r in records],
+                [r[3] for r in records], ttl_seconds)
+            # Bo'sh holatlar saqlanmaydi
+            await conn.execute("""
+                DELETE FROM fsm_states
+                WHERE key = ANY($1::text[]) AND state IS NULL AND data = '{}'::jsonb
+            """, keys)
+
+
+@timed
+@db_retry
+async def delete_expired_fsm_states() -> int:
+    async with acquire() as conn:
+        result = await conn.execute("DELETE FROM fsm_states WHERE expires_at <= NOW()")
+    return int(result.split()[-1])
@@ -0,0 +1,239 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import get_fsm_record, save_fsm_records, delete_expired_fsm_states
+
+# FSM saqlash turi: "memory" (bitta jarayon) yoki "postgres" (bir nechta jarayon)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+# Yozuvlar shu oraliqda yig'ilib, bitta so'rov bilan yoziladi
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_CLEANUP_INTERVAL = 600
+# Xotiradagi saqlashda kalitlar soni chegarasi (eng uzoq ishlatilmaganlari chiqariladi)
+FSM_MEMORY_MAX_KEYS = int(os.getenv("FSM_MEMORY_MAX_KEYS", "100000"))
+
+# set_data chaqirilmagan — bazadagi data o'zgarmaydi
+_UNSET = object()
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class _Record:
+    __slots__ = ("state", "data", "expires_at")
+
+    def __init__(self, expires_at: float):
+        self.state: Optional[str] = None
+        self.data: Optional[Dict[str, Any]] = None
+        self.expires_at = expires_at
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    Bitta jarayon uchun xotiradagi FSM saqlash: muddat (TTL) va hajm chegarasi bilan.
+
+    Har murojaatda yozuv muddati yangilanadi va tartibda oxirga o'tadi, shuning
+    uchun boshida doim eng eski yozuvlar turadi — ular yozishda arzon tozalanadi.
+    """
+
+    def __init__(self, ttl: int = FSM_STATE_TTL, max_keys: int = FSM_MEMORY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.evictions = 0
+        self.expirations = 0
+        self._records: "OrderedDict[StorageKey, _Record]" = OrderedDict()
+
+    def _get(self, key: StorageKey) -> Optional[_Record]:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        now = time.monotonic()
+        if record.expires_at <= now:
+            del self._records[key]
+            self.expirations += 1
+            return None
+        record.expires_at = now + self.ttl
+        self._records.move_to_end(key)
+        return record
+
+    def _get_or_create(self, key: StorageKey) -> _Record:
+        record = self._get(key)
+        if record is None:
+            now = time.monotonic()
+            self._prune(now)
+            record = self._records[key] = _Record(now + self.ttl)
+        return record
+
+    def _prune(self, now: float):
+        records = self._records
+        while records:
+            oldest = next(iter(records.values()))
+            if oldest.expires_at > now:
+                break
+            records.popitem(last=False)
+            self.expirations += 1
+        while len(records) >= self.max_keys:
+            records.popitem(last=False)
+            self.evictions += 1
+
+    def _drop_if_empty(self, key: StorageKey, record: _Record):
+        if record.state is None and not record.data:
+            self._records.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key) if state is None else self._get_or_create(key)
+        if record is None:
+            return
+        record.state = _state_name(state)
+        self._drop_if_empty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key) if not data else self._get_or_create(key)
+        if record is None:
+            return
+        record.data = data.copy()
+        self._drop_if_empty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return record.data.copy() if record and record.data else {}
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._records),
+            "max_size": self.max_keys,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    async def close(self) -> None:
+        self._records.clear()
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM holatlarini fsm_states jadvalida saqlash.
+
+    - Yozuvlar darhol emas, FSM_FLUSH_INTERVAL ichida birlashtirilib yoziladi:
+      ketma-ket fayl yuklashda har fayl uchun alohida so'rov bo'lmaydi
+    - O'qishda avval yozilmagan o'zgarishlar, keyin baza tekshiriladi
+    - Har yozuvda muddat (FSM_STATE_TTL) yangilanadi, eskilari fonda o'chiriladi
+    """
+
+    def __init__(
+        self,
+        ttl: int = FSM_STATE_TTL,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        cleanup_interval: float = FSM_CLEANUP_INTERVAL,
+    ):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        # Bazaga hali yozilmagan o'zgarishlar: key -> [state_o'zgardimi, state, data]
+        self._pending: Dict[str, list] = {}
+        self._flushing: Dict[str, list] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_cleanup = time.monotonic()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+            key.business_connection_id or "", key.destiny,
+        ))
+
+    def _change(self, key: str) -> list:
+        change = self._pending.get(key)
+        if change is None:
+            change = self._pending[key] = [False, None, _UNSET]
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        return change
+
+    def _buffered(self, key: str):
+        # Yangi o'zgarishlar yozilayotganlaridan ustun
+        return self._pending.get(key), self._flushing.get(key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        change = self._change(self._key(key))
+        change[0] = True
+        change[1] = _state_name(state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        skey = self._key(key)
+        for change in self._buffered(skey):
+            if change is not None and change[0]:
+                return change[1]
+        record = await get_fsm_record(skey)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._change(self._key(key))[2] = copy.deepcopy(data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        skey = self._key(key)
+        for change in self._buffered(skey):
+            if change is not None and change[2] is not _UNSET:
+                return copy.deepcopy(change[2])
+        record = await get_fsm_record(skey)
+        return record[1] if record else {}
+
+    async def flush(self):
+        """Yig'ilgan o'zgarishlarni bazaga yozish."""
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        records = [
+            (key, set_state, state, None if data is _UNSET else json.dumps(data, ensure_ascii=False))
+            for key, (set_state, state, data) in self._flushing.items()
+        ]
+        try:
+            await save_fsm_records(records, self.ttl)
+        except BaseException as e:
+            # Yozilmagan o'zgarishlar qaytariladi (bekor qilinganda ham); yangilari ustun
+            for key, (set_state, state, data) in self._flushing.items():
+                change = self._pending.setdefault(key, [False, None, _UNSET])
+                if not change[0] and set_state:
+                    change[0], change[1] = True, state
+                if change[2] is _UNSET:
+                    change[2] = data
+            if not isinstance(e, Exception):
+                raise
+            logging.error(f"FSM holatlarini yozishda xato: {e}")
+        finally:
+            self._flushing = {}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+                self._last_cleanup = time.monotonic()
+                try:
+                    await delete_expired_fsm_states()
+                except Exception as e:
+                    logging.error(f"Eski FSM holatlarini o'chirishda xato: {e}")
+
+    def stats(self) -> dict:
+        return {"pending_writes": len(self._pending)}
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
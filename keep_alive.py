@@ -1,15 +1,62 @@
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-app = Flask('')
+from database import get_pool_stats, get_kino_cache_stats, count_pending_broadcasts
+from metrics import Counter, Gauge
+from webserver import (
+    create_app, start_web_server, register_status_provider, register_metrics_collector
+)
 
-@app.route('/')
-def home():
-    return "Bot tirik!"
+# Bot bilan bir event loopda ishlaydigan holat/metrics serveri (alohida thread yo'q)
 
-def run():
-    app.run(host='0.0.0.0',port=8080)
+db_pool_connections_metric = Gauge(
+    "db_pool_connections", "Pooldagi ulanishlar", ("state",)
+)
+kino_cache_metric = Counter(
+    "kino_cache_requests", "Katalog keshiga murojaatlar", ("result",)
+)
+kino_cache_invalidations_metric = Counter(
+    "kino_cache_invalidations", "Katalog keshini bekor qilishlar"
+)
+kino_cache_size_metric = Gauge(
+    "kino_cache_size", "Katalog keshidagi yozuvlar soni"
+)
+pending_broadcasts_metric = Gauge(
+    "broadcast_jobs_pending", "Tugallanmagan (ishlayotgan yoki to'xtatilgan) yuborishlar"
+)
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+
+def _pool_metric_values():
+    stats = get_pool_stats()
+    if not stats:
+        return {}
+    return {
+        ("idle",): stats["idle"],
+        ("busy",): stats["size"] - stats["idle"],
+    }
+
+
+def _kino_cache_metric_values():
+    stats = get_kino_cache_stats()
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+
+async def _collect_pending_broadcasts():
+    pending_broadcasts_metric.set(await count_pending_broadcasts())
+
+
+def setup_status():
+    """Holat sahifasi va /metrics uchun manbalarni ro'yxatdan o'tkazish."""
+    register_status_provider("db_pool", get_pool_stats)
+    register_status_provider("kino_cache", get_kino_cache_stats)
+    register_status_provider("pending_broadcasts", count_pending_broadcasts)
+
+    db_pool_connections_metric.set_function(_pool_metric_values)
+    kino_cache_metric.set_function(_kino_cache_metric_values)
+    kino_cache_invalidations_metric.set_function(lambda: {(): get_kino_cache_stats()["invalidations"]})
+    kino_cache_size_metric.set_function(lambda: {(): get_kino_cache_stats()["size"]})
+    register_metrics_collector(_collect_pending_broadcasts)
+
+
+async def keep_alive() -> web.AppRunner:
+    """Polling rejimida holat serverini ishga tushirish."""
+    return await start_web_server(create_app())
@@ -1,29 +1,51 @@
 import os
 import re
 import time
+import signal
+import html
 import asyncio
 import logging
-from typing import Union, Any, Dict
+from collections import OrderedDict
+from typing import Union, Any, Dict, Optional
 from aiogram.filters import Command, CommandStart 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.filters import Command, Filter, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.enums import ContentType
+from aiogram.exceptions import TelegramBadRequest
+from fsm_storage import FSM_STORAGE, BoundedMemoryStorage, PostgresStorage
 from typing import List, Dict, Any
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, ChatJoinRequest
+    InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, ChatJoinRequest,
+    ChatMemberUpdated
 )
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from dotenv import load_dotenv
-from keep_alive import keep_alive
+from keep_alive import keep_alive, setup_status
+from webserver import (
+    WEBHOOK_URL, run_webhook, install_update_tracker, install_handler_metrics, register_status_provider
+)
+from bot_api import call_api, install_scheduler, install_api_metrics, bulk_priority
+from broadcast_worker import (
+    BROADCAST_STATUS_LABELS, BROADCAST_SHUTDOWN_TIMEOUT, WORKER_STALE_SECONDS,
+    broadcast_job_keyboard, format_broadcast_job,
+    run_worker as run_broadcast_worker
+)
 from database import (
-    init_db, add_user, get_user_count, get_kino_by_code, get_all_codes,
-    delete_kino_code, get_code_stat, increment_stat, get_all_user_ids,
-    update_anime_code, get_today_users, add_anime, add_part_to_anime,
+    init_db, add_user, get_user_count, get_kino_by_code, list_code_titles, count_codes,
+    get_catalog_version,
+    delete_kino_code, get_code_stat,
+    update_anime_code, get_today_users, add_anime, add_parts_to_anime, get_episode,
     search_anime_by_title, get_channels, add_channel, remove_channel,
-    delete_part_from_anime, get_all_admins, add_admin, remove_admin, db_pool, check_user_request, add_join_request
+    delete_part_from_anime, get_all_admins, add_admin, remove_admin, db_pool, check_user_requests, add_join_request,
+    start_kino_listener, start_db_health_checker, lookup_and_count,
+    start_stats_flusher, close_db, start_known_users_warmup, start_users_flusher,
+    create_broadcast_job, get_broadcast_job, get_broadcast_jobs, set_broadcast_status,
+    count_live_broadcast_workers,
+    count_users, set_user_status, start_title_index_build, get_title_index_stats,
+    start_title_index_rebuilder
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -32,15 +54,38 @@ API_TOKEN = os.getenv("API_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+install_scheduler(bot)  # Interaktiv javoblar ommaviy yuborishlardan oldin o'tadi
+install_api_metrics(bot)
+# Bir nechta bot jarayoni uchun FSM_STORAGE=postgres
+storage = PostgresStorage() if FSM_STORAGE == "postgres" else BoundedMemoryStorage()
 dp = Dispatcher(storage=storage)
 
+
+class UserActivityMiddleware(BaseMiddleware):
+    """
+    Har bir yangilanishda foydalanuvchi faolligini (last_seen) belgilash.
+
+    add_user bazaga bormaydi — navbatga qo'shadi, kuniga bir marta yoziladi.
+    Faqat bot bilan shaxsiy chatdagi yangilanishlar: guruh a'zolari va qo'shilish
+    so'rovlari botni ishga tushirmagan bo'lishi mumkin, my_chat_member esa
+    bloklashni o'zi yozadi.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is not None and chat is not None and chat.type == "private" and event.my_chat_member is None:
+            await add_user(user.id)
+        return await handler(event, data)
+
+
+dp.update.outer_middleware(UserActivityMiddleware())
+
 START_ADMINS = [6486825926, 5492962467]
 ADMINS = set(START_ADMINS)
 BOT_ACTIVE = True
 
 load_dotenv()
-keep_alive()
 
 class AdminStates(StatesGroup):
     waiting_for_kino_data = State()
@@ -54,6 +99,7 @@ class AdminStates(StatesGroup):
     waiting_for_broadcast_type = State()
     waiting_for_forward_data = State()
     waiting_for_simple_message = State()
+    waiting_for_broadcast_audience = State()
 
 class AddAnimeStates(StatesGroup):
     waiting_for_code = State()
@@ -120,8 +166,24 @@ def get_broadcast_type_keyboard() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.button(text="📣 Kanaldan yuborish")
     builder.button(text="📰 Oddiy xabar")
+    builder.button(text="📋 Yuborishlar holati")
     builder.button(text="📡 Boshqarish")
-    builder.adjust(2, 1)  # 2 ta tugma bir qatorda, keyin 1 ta
+    builder.adjust(2, 2)  # 2 ta tugma bir qatorda
+    return builder.as_markup(resize_keyboard=True)
+
+# Auditoriya tugmasi -> (faqat faollar, oxirgi N kun)
+BROADCAST_AUDIENCES = {
+    "👥 Hammaga": (False, None),
+    "🟢 Faol foydalanuvchilar": (True, None),
+    "🕒 Oxirgi 30 kunda faollar": (True, 30),
+}
+
+def get_broadcast_audience_keyboard() -> ReplyKeyboardMarkup:
+    builder = ReplyKeyboardBuilder()
+    for text in BROADCAST_AUDIENCES:
+        builder.button(text=text)
+    builder.button(text="📡 Boshqarish")
+    builder.adjust(1)
     return builder.as_markup(resize_keyboard=True)
 
 def edit_info_fields_inline_keyboard():
@@ -194,34 +256,164 @@ class DeepLinkFilter(Filter):
             return {"match": match, "args": command.args}
         return False
 
+# --- Obuna holati keshi ---
+# (user_id, channel_id) -> (obuna_bo'lganmi, amal_qilish_muddati)
+# Ijobiy natijalar uzoq saqlanadi, salbiylari tez eskiradi — foydalanuvchi
+# kanalga qo'shilgach "Tekshirish" ni bosganda kutib qolmasligi uchun.
+SUB_CACHE_POSITIVE_TTL = int(os.getenv("SUB_CACHE_POSITIVE_TTL", "1800"))
+SUB_CACHE_NEGATIVE_TTL = int(os.getenv("SUB_CACHE_NEGATIVE_TTL", "15"))
+SUB_CACHE_MAX_SIZE = int(os.getenv("SUB_CACHE_MAX_SIZE", "200000"))
+SUB_CHANNELS_TTL = 60
+ADMINS_CACHE_TTL = 60
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+_sub_cache: "OrderedDict[tuple[int, int], tuple[bool, float]]" = OrderedDict()
+_sub_cache_stats = {"hits": 0, "misses": 0}
+_sub_channels_cache: Dict[str, Any] = {"expires_at": 0.0, "channels": []}
+_db_admins_cache: Dict[str, Any] = {"expires_at": 0.0, "admins": set()}
+
+
+def sub_cache_get(user_id: int, channel_id: int) -> Optional[bool]:
+    key = (user_id, channel_id)
+    entry = _sub_cache.get(key)
+    if entry is None:
+        _sub_cache_stats["misses"] += 1
+        return None
+    subscribed, expires_at = entry
+    if expires_at < time.monotonic():
+        _sub_cache.pop(key, None)
+        _sub_cache_stats["misses"] += 1
+        return None
+    _sub_cache_stats["hits"] += 1
+    return subscribed
+
+
+def sub_cache_set(user_id: int, channel_id: int, subscribed: bool):
+    key = (user_id, channel_id)
+    ttl = SUB_CACHE_POSITIVE_TTL if subscribed else SUB_CACHE_NEGATIVE_TTL
+    _sub_cache[key] = (subscribed, time.monotonic() + ttl)
+    _sub_cache.move_to_end(key)
+    while len(_sub_cache) > SUB_CACHE_MAX_SIZE:
+        _sub_cache.popitem(last=False)
+
+
+def sub_cache_invalidate_channel(channel_id: int):
+    """Kanal bo'yicha barcha yozuvlarni o'chirish (kanal o'zgarganda)."""
+    for key in [k for k in _sub_cache if k[1] == channel_id]:
+        del _sub_cache[key]
+
+
+def get_sub_cache_stats() -> dict:
+    hits = _sub_cache_stats["hits"]
+    misses = _sub_cache_stats["misses"]
+    total = hits + misses
+    return {
+        **_sub_cache_stats,
+        "size": len(_sub_cache),
+        "hit_rate": hits / total if total else 0.0,
+    }
+
+
+def invalidate_sub_channels_cache():
+    _sub_channels_cache["expires_at"] = 0.0
+
+
+async def get_cached_sub_channels():
+    now = time.monotonic()
+    if _sub_channels_cache["expires_at"] < now:
+        _sub_channels_cache["channels"] = await get_channels('sub')
+        _sub_channels_cache["expires_at"] = now + SUB_CHANNELS_TTL
+    return _sub_channels_cache["channels"]
+
+
+async def get_cached_db_admins():
+    now = time.monotonic()
+    if _db_admins_cache["expires_at"] < now:
+        _db_admins_cache["admins"] = await get_all_admins()
+        _db_admins_cache["expires_at"] = now + ADMINS_CACHE_TTL
+    return _db_admins_cache["admins"]
+
+
 # --- Helper functions ---
+# Bitta foydalanuvchini tekshirishda bir vaqtda nechta kanal so'raladi
+# (chegara har tekshiruvga alohida — foydalanuvchilar bir-birini kutmaydi)
+SUB_CHECK_CONCURRENCY = int(os.getenv("SUB_CHECK_CONCURRENCY", "8"))
+SUB_CHECK_TIMEOUT = float(os.getenv("SUB_CHECK_TIMEOUT", "5"))
+
+
+async def is_channel_member(channel_id: int, user_id: int, semaphore: asyncio.Semaphore) -> Optional[bool]:
+    """Bitta kanal uchun a'zolikni tekshirish. Xatolik bo'lsa None qaytaradi."""
+    async with semaphore:
+        try:
+            member = await asyncio.wait_for(
+                bot.get_chat_member(channel_id, user_id), timeout=SUB_CHECK_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logging.error(f"Obuna tekshirish vaqti tugadi: {channel_id}")
+            return None
+        except Exception as e:
+            logging.error(f"Obuna tekshirishda xato: {e}")
+            return None
+    return member.status in SUBSCRIBED_STATUSES
+
+
+async def get_requested_channels(user_id: int, channel_ids: List[int]) -> Optional[set]:
+    """So'rov yuborilgan kanallar. Xatolik bo'lsa None qaytaradi."""
+    if not channel_ids:
+        return set()
+    try:
+        return await asyncio.wait_for(check_user_requests(user_id, channel_ids), timeout=SUB_CHECK_TIMEOUT)
+    except Exception as e:
+        logging.error(f"So'rovli kanallarni tekshirishda xato: {e!r}")
+        return None
+
+
 async def get_unsubscribed_channels(user_id: int):
     # Adminlarni o'tkazib yuborish
-    admins = await get_all_admins()
-    if user_id in admins:
+    if user_id in ADMINS or user_id in await get_cached_db_admins():
         return []  # Adminlar uchun hech qanday kanal talab qilinmaydi
 
-    unsubscribed = []
-    channels_data = await get_channels('sub')
+    channels_data = await get_cached_sub_channels()
+    status: Dict[int, Optional[bool]] = {}
+    request_channels = []
+    open_channels = []
+
     for channel in channels_data:
         channel_id = channel['cid']
-        channel_link = channel['link']
-        channel_title = channel['title']
-        mode = channel.get('mode', 'ochiq')
-
-        if mode == 'sorovli':
-            is_requested = await check_user_request(user_id, channel_id)
-            if not is_requested:
-                unsubscribed.append((channel_id, channel_link, channel_title))
+        cached = sub_cache_get(user_id, channel_id)
+        if cached is not None:
+            status[channel_id] = cached
+        elif channel.get('mode', 'ochiq') == 'sorovli':
+            request_channels.append(channel_id)
         else:
-            try:
-                member = await bot.get_chat_member(channel_id, user_id)
-                if member.status not in ["member", "administrator", "creator"]:
-                    unsubscribed.append((channel_id, channel_link, channel_title))
-            except Exception as e:
-                logging.error(f"Obuna tekshirishda xato: {e}")
-                unsubscribed.append((channel_id, channel_link, channel_title))
-    return unsubscribed
+            open_channels.append(channel_id)
+
+    # So'rovli kanallar (bitta baza so'rovi) va ochiq kanallar (har biri o'z
+    # timeouti bilan) — hammasi parallel
+    semaphore = asyncio.Semaphore(SUB_CHECK_CONCURRENCY)
+    requested, *results = await asyncio.gather(
+        get_requested_channels(user_id, request_channels),
+        *(is_channel_member(channel_id, user_id, semaphore) for channel_id in open_channels)
+    )
+    checked = dict(zip(open_channels, results))
+    if requested is not None:
+        checked.update((channel_id, channel_id in requested) for channel_id in request_channels)
+    for channel_id in request_channels + open_channels:
+        is_member = checked.get(channel_id)
+        if is_member is None:
+            # Tekshirib bo'lmadi (Telegram/baza sekin yoki xato): obuna bo'lgan
+            # foydalanuvchi to'sib qo'yilmasin — o'tkaziladi, lekin keshlanmaydi
+            status[channel_id] = True
+        else:
+            status[channel_id] = is_member
+            sub_cache_set(user_id, channel_id, is_member)
+
+    return [
+        (channel['cid'], channel['link'], channel['title'])
+        for channel in channels_data
+        if not status.get(channel['cid'])
+    ]
 
 async def make_unsubscribed_markup(user_id, code):
     unsubscribed = await get_unsubscribed_channels(user_id)
@@ -237,13 +429,35 @@ async def on_join_request(event: ChatJoinRequest):
     user_id = event.from_user.id
     channel_id = event.chat.id
     await add_join_request(user_id, channel_id)  # ✅ Xavfsiz, allaqachon mavjud
+    sub_cache_set(user_id, channel_id, True)
+
+@dp.chat_member()
+async def on_chat_member_update(event: ChatMemberUpdated):
+    """Kanal a'zoligi o'zgarganda keshni darhol yangilash."""
+    user_id = event.new_chat_member.user.id
+    channel_id = event.chat.id
+    if event.new_chat_member.status in SUBSCRIBED_STATUSES:
+        sub_cache_set(user_id, channel_id, True)
+    else:
+        # So'rovli kanalda so'rov hali ham hisoblanadi — qayta tekshirilsin
+        _sub_cache.pop((user_id, channel_id), None)
+
+@dp.my_chat_member()
+async def on_bot_member_update(event: ChatMemberUpdated):
+    """Botning kanaldagi huquqlari o'zgarsa — shu kanal keshi eskiradi.
+    Shaxsiy chatda — foydalanuvchi botni bloklagan yoki qayta yoqgan."""
+    if event.chat.type in ("channel", "supergroup", "group"):
+        sub_cache_invalidate_channel(event.chat.id)
+        invalidate_sub_channels_cache()
+    elif event.chat.type == "private":
+        status = "blocked" if event.new_chat_member.status == "kicked" else "active"
+        await set_user_status(event.chat.id, status)
 
 # --- Handlers ---
 
 @dp.message(Command("start"), DeepLinkFilter(re.compile(r'part_(\d+)_(\d+)')))
 async def download_part_by_deeplink(message: Message, match: re.Match, args: str):
     user_id = message.from_user.id
-    await add_user(user_id)
     
     code = match.group(1)
     part_number = int(match.group(2))
@@ -258,21 +472,15 @@ async def download_part_by_deeplink(message: Message, match: re.Match, args: str
         await message.answer("🛑 Davom etish uchun quyidagi kanallarga obuna bo‘lishingiz shart:", reply_markup=builder.as_markup())
         return
 
-    kino = await get_kino_by_code(code)
-    if not kino:
-        await message.answer("❌ Anime topilmadi.")
-        return
-
-    parts_file_ids = kino.get("parts_file_ids", [])
-    if not (0 < part_number <= len(parts_file_ids)):
+    episode = await get_episode(code, part_number)
+    if not episode:
         await message.answer("❌ So‘ralgan qism mavjud emas.")
         return
 
-    file_id = parts_file_ids[part_number - 1]
     msg = await message.answer("⏳ Qism yuklanmoqda, iltimos kuting...")
     
     try:
-        await message.answer_document(document=file_id, caption=f"{kino.get('title')} [{part_number}-qism]")
+        await message.answer_document(document=episode["file_id"], caption=f"{episode['title']} [{part_number}-qism]")
         await msg.delete()
         
         if user_id in ADMINS:
@@ -286,29 +494,24 @@ async def download_part_by_deeplink(message: Message, match: re.Match, args: str
 @dp.message(Command("start"), DeepLinkFilter(re.compile(r'^\d+$')))
 async def download_all_by_deeplink(message: Message, args: str):
     user_id = message.from_user.id
-    await add_user(user_id)
     code = args
 
     if not BOT_ACTIVE and user_id not in ADMINS:
         await message.answer("📴 Bot hozircha o'chirilgan.")
         return
 
-    await increment_stat(code, "init")
     unsubscribed = await get_unsubscribed_channels(user_id)
     if unsubscribed:
         markup = await make_unsubscribed_markup(user_id, code)
         await message.answer("❗ Animeni olishdan oldin quyidagi kanallarga obuna bo‘ling:", reply_markup=markup)
     else:
-        # send_reklama_post funksiyasini chaqirish (o'zingizda bor deb hisoblaymiz)
-        await send_reklama_post(user_id, code)
-        await increment_stat(code, "viewed")
+        await send_reklama_post(user_id, code, count_fields=("viewed",))
 
 START_CAPTION = "✨"
 
 @dp.message(Command("start"))
 async def start_handler(message: Message):
     user_id = message.from_user.id
-    await add_user(user_id)
     
     if user_id in ADMINS:
         await send_admin_panel(message)
@@ -427,33 +630,102 @@ async def show_full_anime(callback: CallbackQuery):
         )
         return
 
-    await increment_stat(code, "init")
-    await increment_stat(code, "searched")
-    
-    # Reklama postini yuborish funksiyasi
-    await send_reklama_post(user_id, code)
+    # Reklama postini yuborish funksiyasi (statistika shu yerda yoziladi)
+    await send_reklama_post(user_id, code, count_fields=("searched",))
     await callback.answer()
 
 # --- 🎞 Barcha animelar ---
 
+# Katalog bitta xabarda sahifalab ko'rsatiladi; sahifa tugmalari shu xabarni tahrirlaydi
+CATALOG_PAGE_SIZE = 30
+CATALOG_CACHE_SIZE = 200
+# Versiya xabari kelmay qolsa ham (masalan, LISTEN ulanishi uzilganda) eskirgan sahifa uzoq turmaydi
+CATALOG_PAGE_TTL = 300
+
+# so'ralgan sahifa -> (muddati, matn, klaviatura); katalog versiyasi o'zgarsa butunlay tozalanadi
+_catalog_pages: "OrderedDict[int, tuple[float, str, InlineKeyboardMarkup]]" = OrderedDict()
+_catalog_pages_version = -1
+
+
+def catalog_keyboard(page: int, pages: int) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="⬅️", callback_data=f"catalog:{page - 1}")
+    builder.button(text=f"{page + 1}/{pages}", callback_data="catalog:noop")
+    if page < pages - 1:
+        builder.button(text="➡️", callback_data=f"catalog:{page + 1}")
+    return builder.as_markup()
+
+
+async def render_catalog_page(page: int) -> Optional[tuple[str, InlineKeyboardMarkup]]:
+    """Sahifa matni va tugmalari (keshdan). Katalog bo'sh bo'lsa None."""
+    global _catalog_pages_version
+    version = get_catalog_version()
+    if version != _catalog_pages_version:
+        _catalog_pages.clear()
+        _catalog_pages_version = version
+
+    requested = page = max(page, 0)
+    cached = _catalog_pages.get(requested)
+    if cached is not None:
+        if cached[0] > time.monotonic():
+            _catalog_pages.move_to_end(requested)
+            return cached[1:]
+        del _catalog_pages[requested]
+
+    total = await count_codes()
+    if not total:
+        return None
+    pages = (total + CATALOG_PAGE_SIZE - 1) // CATALOG_PAGE_SIZE
+    page = min(page, pages - 1)
+    rows = await list_code_titles("code", page * CATALOG_PAGE_SIZE, CATALOG_PAGE_SIZE)
+
+    text = f"📄 <b>Barcha animelar</b> ({total} ta):\n\n"
+    for row in rows:
+        text += f"<code>{html.escape(row['code'])}</code> – <i>{html.escape(row['title'] or '')}</i>\n"
+    rendered = (text, catalog_keyboard(page, pages))
+
+    # Hisoblash paytida katalog o'zgargan bo'lsa, eskirgan sahifa saqlanmaydi
+    # Chegaradan tashqari sahifa (eski tugma) ham so'ralgan raqami bilan saqlanadi
+    if get_catalog_version() == version:
+        expires_at = time.monotonic() + CATALOG_PAGE_TTL
+        for key in {page, requested}:
+            _catalog_pages[key] = (expires_at, *rendered)
+        while len(_catalog_pages) > CATALOG_CACHE_SIZE:
+            _catalog_pages.popitem(last=False)
+    return rendered
+
+
+async def send_catalog(message: Message, empty_text: str):
+    rendered = await render_catalog_page(0)
+    if rendered is None:
+        await message.answer(empty_text)
+        return
+    text, markup = rendered
+    await message.answer(text, parse_mode="HTML", reply_markup=markup)
+
+
 @dp.message(F.text == "🎞 Barcha animelar")
 async def show_all_animes(message: Message):
-    kodlar = await get_all_codes()
-    if not kodlar:
-        await message.answer("⛔️ Hozircha animelar yoʻq.")
-        return
+    await send_catalog(message, "⛔️ Hozircha animelar yoʻq.")
 
-    # Kodlar bo'yicha tartiblash
-    kodlar = sorted(kodlar, key=lambda x: int(x["code"]))
 
-    chunk_size = 100
-    for i in range(0, len(kodlar), chunk_size):
-        chunk = kodlar[i:i + chunk_size]
-        text = "📄 *Barcha animelar:*\n\n"
-        for row in chunk:
-            text += f"`{row['code']}` – *{row['title']}*\n"
-        
-        await message.answer(text, parse_mode="Markdown")
+@dp.callback_query(F.data.startswith("catalog:"))
+async def catalog_page_callback(callback: CallbackQuery):
+    value = callback.data.split(":", 1)[1]
+    if not value.isdigit():
+        await callback.answer()
+        return
+    rendered = await render_catalog_page(int(value))
+    if rendered is None:
+        await callback.answer("⛔️ Hozircha animelar yoʻq.", show_alert=True)
+        return
+    text, markup = rendered
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+    except TelegramBadRequest:
+        pass  # Xabar o'zgarmagan (masalan, tugma ikki marta bosilgan)
+    await callback.answer()
 
 # --- ✉️ Admin bilan bog‘lanish ---
 
@@ -480,21 +752,20 @@ async def forward_to_admins(message: Message, state: FSMContext):
     await state.clear()
     user = message.from_user
 
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="✉️ Javob yozish", callback_data=f"reply_user:{user.id}"))
+    text = (
+        f"📩 <b>Yangi xabar:</b>\n\n"
+        f"<b>👤 Foydalanuvchi:</b> {user.full_name} | <code>{user.id}</code>\n"
+        f"<b>💬 Xabar:</b> {message.text}"
+    )
+
     for admin_id in ADMINS:
-        try:
-            builder = InlineKeyboardBuilder()
-            builder.add(InlineKeyboardButton(text="✉️ Javob yozish", callback_data=f"reply_user:{user.id}"))
-
-            await bot.send_message(
-                admin_id,
-                f"📩 <b>Yangi xabar:</b>\n\n"
-                f"<b>👤 Foydalanuvchi:</b> {user.full_name} | <code>{user.id}</code>\n"
-                f"<b>💬 Xabar:</b> {message.text}",
-                parse_mode="HTML",
-                reply_markup=builder.as_markup()
-            )
-        except Exception as e:
-            print(f"Adminga yuborishda xatolik: {e}")
+        result = await call_api(lambda: bot.send_message(
+            admin_id, text, parse_mode="HTML", reply_markup=builder.as_markup()
+        ))
+        if not result.ok:
+            print(f"Adminga yuborishda xatolik ({result.status.value}): {result.error}")
 
     await message.answer(
         "✅ Xabaringiz yuborildi. Tez orada admin siz bilan bog‘lanadi.",
@@ -678,6 +949,8 @@ async def add_channel_finish(message: Message, state: FSMContext):
         ctype=data['channel_type'],
         mode=data['channel_mode']
     )
+    invalidate_sub_channels_cache()
+    sub_cache_invalidate_channel(data['channel_id'])
     await message.answer(f"✅ Kanal ({data['channel_mode']}) muvaffaqiyatli saqlandi!", reply_markup=admin_keyboard())
     await state.clear()
 
@@ -688,6 +961,8 @@ async def delete_channel_process(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     ctype = data.get('channel_type', 'sub')  # 'sub' yoki 'main'
     await remove_channel(cid, ctype=ctype)  # ✅ Faqat tanlangan tur o'chiriladi
+    invalidate_sub_channels_cache()
+    sub_cache_invalidate_channel(cid)
     await callback.answer("✅ Kanal o‘chirildi!")
     # Menyuni qayta ko'rsatish
     await select_channel_type(callback, state)
@@ -862,11 +1137,8 @@ async def finish_adding_parts(message: Message, state: FSMContext):
     if not new_parts:
         await message.answer("❗ Hech qanday qism qo‘shilmadi.", reply_markup=admin_keyboard())
     else:
-        # Mavjud qismlarga qo'shamiz
-        anime = await get_kino_by_code(data["code"])
-        old_parts = anime.get("parts_file_ids", [])
-        all_parts = old_parts + new_parts
-        await update_anime_code(data["code"], data["code"], anime["title"], parts_file_ids=all_parts)
+        # Mavjud qismlar oxiriga qo'shiladi
+        await add_parts_to_anime(data["code"], new_parts)
         await message.answer(f"✅ {len(new_parts)} ta qism qo‘shildi.", reply_markup=admin_keyboard())
     await state.clear()
 
@@ -882,12 +1154,8 @@ async def delete_part_by_number(message: Message, state: FSMContext):
     data = await state.get_data()
     try:
         part_num = int(message.text.strip())
-        anime = await get_kino_by_code(data["code"])
-        parts = anime.get("parts_file_ids", [])
-        if not (1 <= part_num <= len(parts)):
+        if not await delete_part_from_anime(data["code"], part_num):
             raise ValueError
-        parts.pop(part_num - 1)
-        await update_anime_code(data["code"], data["code"], anime["title"], parts_file_ids=parts)
         await message.answer(f"✅ {part_num}-qism o‘chirildi.", reply_markup=admin_keyboard())
     except (ValueError, IndexError):
         await message.answer("❌ Noto‘g‘ri qism raqami.")
@@ -982,17 +1250,17 @@ async def part_post_code_handler(message: Message, state: FSMContext):
         await message.answer("❌ Bunday kod topilmadi.")
         return
     
-    parts = kino.get('parts_file_ids', [])
-    await state.update_data(code=code, title=kino['title'], parts_file_ids=parts)
+    parts_count = len(kino.get('parts_file_ids', []))
+    await state.update_data(code=code, title=kino['title'], parts_count=parts_count)
     await state.set_state(PartPostStates.waiting_for_part_number)
-    await message.answer(f"✅ {kino['title']} (jami {len(parts)} qism).\nNechinchi qismni post qilmoqchisiz?")
+    await message.answer(f"✅ {kino['title']} (jami {parts_count} qism).\nNechinchi qismni post qilmoqchisiz?")
 
 @dp.message(PartPostStates.waiting_for_part_number)
 async def part_post_number_handler(message: Message, state: FSMContext):
     data = await state.get_data()
     try:
         part_num = int(message.text.strip())
-        if not (1 <= part_num <= len(data['parts_file_ids'])): raise ValueError
+        if not (1 <= part_num <= data['parts_count']): raise ValueError
     except:
         await message.answer("❌ Noto'g'ri qism raqami.")
         return
@@ -1034,7 +1302,6 @@ async def download_part_by_deeplink(message: Message, command: CommandObject):
         return
 
     user_id = message.from_user.id
-    await add_user(user_id)
     
     try:
         _, code, part_number = args.split('_')
@@ -1059,13 +1326,13 @@ async def download_part_by_deeplink(message: Message, command: CommandObject):
 # === 🛠 Yordamchi funksiya: Qismni yuborish ===
 
 async def send_anime_part(event, code, part_number):
-    kino = await get_kino_by_code(code)
-    if not kino or part_number > len(kino['parts_file_ids']):
+    episode = await get_episode(code, part_number)
+    if not episode:
         target = event.message if isinstance(event, CallbackQuery) else event
         await target.answer("❌ Qism topilmadi.")
         return
 
-    file_id = kino['parts_file_ids'][part_number - 1]
+    file_id = episode["file_id"]
     msg = event.message if isinstance(event, CallbackQuery) else event
     
     await msg.answer("⏳ Yuklanmoqda...")
@@ -1109,20 +1376,13 @@ async def check_part_subscription(callback: CallbackQuery):
         code, part_number_str = data.split('_')
         part_number = int(part_number_str)
 
-        kino = await get_kino_by_code(code)
-        if not kino:
-            await callback.message.answer("❌ Anime topilmadi.")
-            return
-
-        title = kino.get("title", "Anime")
-        parts_file_ids = kino.get("parts_file_ids", [])
-        
-        if not parts_file_ids or part_number > len(parts_file_ids) or part_number < 1:
+        episode = await get_episode(code, part_number)
+        if not episode:
             await callback.message.answer("❌ So‘ralgan qism mavjud emas.")
             return
             
-        file_id = parts_file_ids[part_number - 1]
-        caption = f"{title} [{part_number}-qism]"
+        file_id = episode["file_id"]
+        caption = f"{episode['title'] or 'Anime'} [{part_number}-qism]"
         
         # 3. Qismni yuborish
         await callback.message.answer("⏳ Qism yuklanmoqda, iltimos kuting...")
@@ -1336,20 +1596,23 @@ async def send_post_by_code(message: Message, state: FSMContext):
         ch_id = ch['cid']
         ch_title = ch['title']
 
-        try:
-            file_id = kino['poster_file_id']
-            poster_type = kino.get('poster_type', 'photo')
-            
-            if poster_type == "video":
-                await bot.send_video(chat_id=ch_id, video=file_id, caption=caption, reply_markup=builder.as_markup())
-            elif poster_type == "document":
-                await bot.send_document(chat_id=ch_id, document=file_id, caption=caption, reply_markup=builder.as_markup())
-            else:  # photo
-                await bot.send_photo(chat_id=ch_id, photo=file_id, caption=caption, reply_markup=builder.as_markup())
-                
+        file_id = kino['poster_file_id']
+        poster_type = kino.get('poster_type', 'photo')
+
+        if poster_type == "video":
+            make_request = lambda: bot.send_video(chat_id=ch_id, video=file_id, caption=caption, reply_markup=builder.as_markup())
+        elif poster_type == "document":
+            make_request = lambda: bot.send_document(chat_id=ch_id, document=file_id, caption=caption, reply_markup=builder.as_markup())
+        else:  # photo
+            make_request = lambda: bot.send_photo(chat_id=ch_id, photo=file_id, caption=caption, reply_markup=builder.as_markup())
+
+        # Kanal postlari ommaviy trafik — foydalanuvchi javoblarini kutdirmaydi
+        with bulk_priority():
+            result = await call_api(make_request)
+        if result.ok:
             successful += 1
-        except Exception as e:
-            logging.error(f"Kanal {ch_id} ({ch_title}) ga post yuborishda xato: {e}")
+        else:
+            logging.error(f"Kanal {ch_id} ({ch_title}) ga post yuborishda xato ({result.status.value}): {result.error}")
             failed += 1
 
     await message.answer(
@@ -1362,23 +1625,8 @@ async def send_post_by_code(message: Message, state: FSMContext):
 
 # === 📄 Kodlar ro'yxati ===
 @dp.message(F.text == "📄 Kodlar ro‘yxati", F.from_user.id.in_(ADMINS))
-async def show_all_animes(message: Message):
-    kodlar = await get_all_codes()
-    if not kodlar:
-        await message.answer("Ba'zada hech qanday kodlar yo'q!")
-        return
-
-    # Kodlarni tartiblash
-    kodlar = sorted(kodlar, key=lambda x: int(x["code"]))
-    
-    # Telegram xabar limiti (4096 belgi) sababli bo'lib yuborish
-    chunk_size = 50 
-    for i in range(0, len(kodlar), chunk_size):
-        chunk = kodlar[i:i + chunk_size]
-        text = "📄 <b>Barcha animelar:</b>\n\n"
-        for row in chunk:
-            text += f"<code>{row['code']}</code> – <i>{row['title']}</i>\n"
-        await message.answer(text, parse_mode="HTML")
+async def show_all_codes(message: Message):
+    await send_catalog(message, "Ba'zada hech qanday kodlar yo'q!")
 
 # === 📊 Statistika ===
 @dp.message(F.text == "📊 Statistika", F.from_user.id.in_(ADMINS))
@@ -1390,15 +1638,17 @@ async def stats(message: Message):
         await conn.fetch("SELECT 1;")
         ping = (time.perf_counter() - start_time) * 1000
 
-    kodlar = await get_all_codes()
+    kodlar_soni = await count_codes()
     foydalanuvchilar = await get_user_count()
     today_users = await get_today_users()
+    active_users = await count_users(active_only=True)
     
     text = (
         f"⚡️ <b>Ulanish tezligi:</b> {ping:.2f} ms\n"
         f"👥 <b>Jami foydalanuvchilar:</b> {foydalanuvchilar} ta\n"
         f"📅 <b>Bugun qo'shilganlar:</b> {today_users} ta\n"
-        f"📂 <b>Baza hajmi:</b> {len(kodlar)} ta anime"
+        f"📬 <b>Xabar yetib boradiganlar:</b> {active_users} ta\n"
+        f"📂 <b>Baza hajmi:</b> {kodlar_soni} ta anime"
     )
     await message.answer(text, parse_mode="HTML", reply_markup=admin_keyboard())
 
@@ -1410,133 +1660,63 @@ async def back_to_admin_menu(message: Message, state: FSMContext):
 
 # === 📢 Habar yuborish ===
 
-async def background_broadcast(
-    message: Message,
-    users: list[int],
-    broadcast_info: dict[str, Any],
-    bot: Bot
-):
-    """
-    Flood control bilan himoyalangan xabar yuborish (HTML parse mode bilan)
-    """
-    success = 0
-    fail = 0
-    total_users = len(users)
-
-    BATCH_SIZE = 15
-    BATCH_DELAY = 2
-    PER_USER_DELAY = 0.1
-
-    admin_id = message.chat.id
-
-    # Habar yuborish funksiyasi (avvalgiday)
-    if broadcast_info.get('type') == 'forward':
-        channel_username = broadcast_info['channel_username']
-        msg_id = broadcast_info['msg_id']
-
-        async def send_func(user_id: int) -> bool:
-            retries = 0
-            while retries < 5:
-                try:
-                    await bot.forward_message(user_id, channel_username, msg_id)
-                    return True
-                except Exception as e:
-                    error_text = str(e).lower()
-                    if "flood control" in error_text or "too many requests" in error_text:
-                        match = re.search(r"retry in (\d+)", error_text)
-                        wait_time = int(match.group(1)) if match else 1
-                        await asyncio.sleep(wait_time + 1)
-                        retries += 1
-                    else:
-                        return False
-            return False
-    else:
-        source_chat_id = admin_id
-        message_id = broadcast_info['message_id']
-
-        async def send_func(user_id: int) -> bool:
-            retries = 0
-            while retries < 5:
-                try:
-                    await bot.copy_message(user_id, source_chat_id, message_id)
-                    return True
-                except Exception as e:
-                    error_text = str(e).lower()
-                    if "flood control" in error_text or "too many requests" in error_text:
-                        match = re.search(r"retry in (\d+)", error_text)
-                        wait_time = int(match.group(1)) if match else 1
-                        await asyncio.sleep(wait_time + 1)
-                        retries += 1
-                    else:
-                        return False
-            return False
+# Yuborishni workerlar bajaradi — bu yerda faqat navbatga qo'yiladi.
+# Standart holatda worker shu jarayonda ham ishlaydi; alohida broadcast_worker.py
+# jarayon(lar)i ishlatilsa RUN_BROADCAST_WORKER=0 qo'yiladi.
+RUN_BROADCAST_WORKER = os.getenv("RUN_BROADCAST_WORKER", "1") == "1"
+NO_WORKER_WARNING = "⚠️ Hozir birorta ham broadcast worker ishlamayapti — yuborish worker ishga tushganda boshlanadi."
+
 
-    # Boshlanish xabari (HTML bilan)
+async def enqueue_broadcast(
+    admin_id: int, btype: str, source_chat, message_id: int,
+    active_only: bool = False, seen_days: Optional[int] = None
+):
+    """Vazifani bazaga yozish. Yuborishni workerlar bajaradi."""
+    total = await count_users(active_only, seen_days)
+    # Boshlanish xabari (HTML bilan) — workerlar shu xabarni tahrirlab boradi
     status_msg = await bot.send_message(
         admin_id,
-        f"⏳ <b>Boshlandi!</b> Jami {total_users} ta foydalanuvchiga yuborish.",
+        f"⏳ <b>Navbatga qo'yildi!</b> Jami {total} ta foydalanuvchiga yuborish.",
         parse_mode="HTML"
     )
-    
-    for i in range(0, total_users, BATCH_SIZE):
-        batch = users[i:i + BATCH_SIZE]
-        for user_id in batch:
-            if user_id == admin_id:
-                continue
-                
-            ok = await send_func(user_id)
-            if ok:
-                success += 1
-            else:
-                fail += 1
-            await asyncio.sleep(PER_USER_DELAY)
-
-        await asyncio.sleep(BATCH_DELAY)
-
-        # Progress yangilash (HTML bilan)
-        remaining = total_users - (i + len(batch))
-        try:
-            await bot.edit_message_text(
-                chat_id=admin_id,
-                message_id=status_msg.message_id,
-                text=(
-                    f"📤 Yuborilmoqda...\n\n"
-                    f"👥 Jami: {total_users}\n"
-                    f"✅ Yuborildi: {success}\n"
-                    f"❌ Xatolik: {fail}\n"
-                    f"⏳ Kutilmoqda: {remaining}"
-                ),
-                parse_mode="HTML"
-            )
-        except Exception:
-            pass
-
-    # Yakuniy hisobot (HTML bilan)
+    job_id = await create_broadcast_job(
+        admin_id, btype, source_chat, message_id, total, active_only, seen_days,
+        status_message_id=status_msg.message_id
+    )
+    job = await get_broadcast_job(job_id)
+    text = format_broadcast_job(job)
+    if not await count_live_broadcast_workers(WORKER_STALE_SECONDS):
+        logging.warning(f"Yuborish #{job_id} navbatga qo'yildi, lekin tirik broadcast worker yo'q")
+        text += f"\n\n{NO_WORKER_WARNING}"
     try:
-        await bot.edit_message_text(
-            chat_id=admin_id,
-            message_id=status_msg.message_id,
-            text=(
-                f"✅ <b>Yuborish tugadi!</b>\n"
-                f"Jami foydalanuvchilar: {total_users}\n"
-                f"Muvaqqiyatli: {success}\n"
-                f"Xato: {fail}"
-            ),
-            parse_mode="HTML",
-            reply_markup=admin_keyboard()
-        )
+        await status_msg.edit_text(text, parse_mode="HTML", reply_markup=broadcast_job_keyboard(job))
     except Exception:
-        await bot.send_message(
-            admin_id,
-            f"✅ <b>Yuborish tugadi!</b>\n"
-            f"Jami: {total_users} | Muvaffaqiyatli: {success} | Xato: {fail}",
-            parse_mode="HTML",
-            reply_markup=admin_keyboard()
-        )
+        pass
+    return job_id
 
-# 1. Habar yuborish tugmasi bosilganda
+# 1. Habar yuborish tugmasi bosilganda — avval auditoriya tanlanadi
 @dp.message(F.text == "📢 Habar yuborish", F.from_user.id.in_(ADMINS))
+async def ask_broadcast_audience(message: Message, state: FSMContext):
+    await state.set_state(AdminStates.waiting_for_broadcast_audience)
+    await message.answer(
+        "Xabar kimlarga yuborilsin?",
+        reply_markup=get_broadcast_audience_keyboard()
+    )
+
+@dp.message(AdminStates.waiting_for_broadcast_audience, F.from_user.id.in_(ADMINS))
 async def ask_broadcast_type(message: Message, state: FSMContext):
+    if message.text == "📡 Boshqarish":
+        await state.clear()
+        await send_admin_panel(message)
+        return
+
+    audience = BROADCAST_AUDIENCES.get(message.text)
+    if audience is None:
+        await message.answer("❗ Noto'g'ri tanlov.", reply_markup=get_broadcast_audience_keyboard())
+        return
+
+    active_only, seen_days = audience
+    await state.update_data(active_only=active_only, seen_days=seen_days)
     await state.set_state(AdminStates.waiting_for_broadcast_type)
     await message.answer(
         "Qanday turdagi xabar yubormoqchisiz?",
@@ -1567,6 +1747,8 @@ async def process_broadcast_type(message: Message, state: FSMContext):
             parse_mode="MarkdownV2",
             reply_markup=control_keyboard()
         )
+    elif message.text == "📋 Yuborishlar holati":
+        await show_broadcast_jobs(message)
     else:
         await message.answer(
             "❗ Noto'g'ri tanlov\\.",
@@ -1574,6 +1756,45 @@ async def process_broadcast_type(message: Message, state: FSMContext):
             reply_markup=get_broadcast_type_keyboard()
         )
 
+# Yuborishlar holati
+async def show_broadcast_jobs(message: Message):
+    jobs = await get_broadcast_jobs(limit=5)
+    if not jobs:
+        await message.answer("📭 Hali yuborishlar yo‘q.")
+        return
+    for job in jobs:
+        await message.answer(
+            format_broadcast_job(job),
+            parse_mode="HTML",
+            reply_markup=broadcast_job_keyboard(job)
+        )
+
+@dp.callback_query(F.data.startswith("bjob:"), F.from_user.id.in_(ADMINS))
+async def control_broadcast_job(callback: CallbackQuery):
+    _, action, job_id = callback.data.split(":")
+    job_id = int(job_id)
+    new_status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}.get(action)
+    if not new_status:
+        await callback.answer("❗ Noma'lum amal.", show_alert=True)
+        return
+
+    # Workerlar holatni har nazorat nuqtasida o'qiydi; davom ettirilganda bo'laklarni qayta oladi
+    if not await set_broadcast_status(job_id, new_status):
+        await callback.answer("❗ Bu holatda amalni bajarib bo‘lmaydi.", show_alert=True)
+    else:
+        await callback.answer(BROADCAST_STATUS_LABELS[new_status])
+
+    job = await get_broadcast_job(job_id)
+    if job:
+        try:
+            await callback.message.edit_text(
+                format_broadcast_job(job),
+                parse_mode="HTML",
+                reply_markup=broadcast_job_keyboard(job)
+            )
+        except Exception:
+            pass
+
 # 3a. Kanaldan yuborish ma'lumotlarini qabul qilish
 @dp.message(AdminStates.waiting_for_forward_data, F.from_user.id.in_(ADMINS))
 async def start_forward_broadcast(message: Message, state: FSMContext):
@@ -1601,16 +1822,14 @@ async def start_forward_broadcast(message: Message, state: FSMContext):
         return
 
     # State'ni tozalash
+    data = await state.get_data()
     await state.clear()
 
-    # Yuborishni asinxron boshlash
-    users = await get_all_user_ids()
-    broadcast_info = {
-        'type': 'forward',
-        'channel_username': channel_username,
-        'msg_id': int(msg_id_str)
-    }
-    asyncio.create_task(background_broadcast(message, users, broadcast_info, bot))
+    # Vazifani bazaga yozib, asinxron boshlash
+    await enqueue_broadcast(
+        message.chat.id, 'forward', channel_username, int(msg_id_str),
+        data.get("active_only", False), data.get("seen_days")
+    )
 
 # 3b. Oddiy xabar ma'lumotlarini qabul qilish (har qanday kontent turi)
 @dp.message(AdminStates.waiting_for_simple_message, F.from_user.id.in_(ADMINS))
@@ -1634,14 +1853,13 @@ async def start_simple_broadcast(message: Message, state: FSMContext):
         # return
 
     # State'ni tozalash va yuborishni boshlash
+    data = await state.get_data()
     await state.clear()
 
-    users = await get_all_user_ids()
-    broadcast_info = {
-        'type': 'copy',
-        'message_id': message.message_id
-    }
-    asyncio.create_task(background_broadcast(message, users, broadcast_info, bot))
+    await enqueue_broadcast(
+        message.chat.id, 'copy', message.chat.id, message.message_id,
+        data.get("active_only", False), data.get("seen_days")
+    )
 
 # === 🔢 Kodni qidirish (Faqat raqam yuborilganda) ===
 @dp.message(F.text.isdigit())
@@ -1664,17 +1882,13 @@ async def handle_code_message(message: Message):
         return
 
     code = message.text
-    # Statistika yuritish
-    await increment_stat(code, "init")
-    await increment_stat(code, "searched")
-    
-    # Reklama postini chiqarish
-    await send_reklama_post(user_id, code)
-    await increment_stat(code, "viewed")
+    # Reklama postini chiqarish va statistika yuritish
+    await send_reklama_post(user_id, code, count_fields=("searched", "viewed"))
 
 # === 🖼 Reklama post yuborish funksiyasi ===
-async def send_reklama_post(user_id, code):
-    data = await get_kino_by_code(code)
+async def send_reklama_post(user_id, code, count_fields=()):
+    # Yozuv va statistika bitta so'rovda
+    data, view_count = await lookup_and_count(code, count_fields)
     if not data:
         await bot.send_message(user_id, "❌ Kod topilmadi.")
         return
@@ -1688,10 +1902,6 @@ async def send_reklama_post(user_id, code):
     parts_file_ids = data.get('parts_file_ids', [])
     parts_count = len(parts_file_ids)
 
-    # Ko'rish statistikasi
-    stat_data = await get_code_stat(code)
-    view_count = stat_data["viewed"] if stat_data else 0  # dict deb faraz qilamiz
-
     # ✅ Janrni sozlash: agar bo'sh bo'lsa "—", agar bir nechta so'z bo'lsa vergul qo'yish
     if genre:
         # Agar foydalanuvchi "Drama Ekshin Sarguzasht" deb yozgan bo'lsa — ajratish
@@ -1747,23 +1957,17 @@ async def download_single_part(callback: CallbackQuery):
 
     await callback.answer(f"⏳ {part_number}-qism yuborilmoqda...")
     
-    result = await get_kino_by_code(code)
-    if not result:
-        await callback.message.answer("❌ Anime topilmadi.")
-        return
-
-    parts_file_ids = result.get("parts_file_ids", [])
-    if part_number < 1 or part_number > len(parts_file_ids):
+    # Faqat kerakli qism olinadi (indeksli so'rov), butun ro'yxat emas
+    episode = await get_episode(code, part_number)
+    if not episode:
         await callback.message.answer("❌ Bu qism mavjud emas.")
         return
-        
-    file_id = parts_file_ids[part_number - 1]
     
     try:
         await bot.send_document(
             chat_id=callback.from_user.id,
-            document=file_id,
-            caption=f"{result.get('title', 'Anime')} [{part_number}-qism]"
+            document=episode["file_id"],
+            caption=f"{episode['title'] or 'Anime'} [{part_number}-qism]"
         )
     except Exception as e:
         await callback.message.answer("❌ Faylni yuborishda xatolik. Botni bloklamaganingizga ishonch hosil qiling.")
@@ -1771,8 +1975,51 @@ async def download_single_part(callback: CallbackQuery):
 # === 🚀 MAIN ===
 async def main():
     await init_db() # Baza ishga tushishi
+    await start_kino_listener()  # Katalog keshini boshqa jarayonlar bilan sinxronlash
+    start_title_index_build()  # Tayyor bo'lguncha qidiruv pg_trgm bilan, keyin xotirada
+    start_title_index_rebuilder()
+    start_db_health_checker()  # Pool holati fonda tekshiriladi
+    start_stats_flusher()  # Statistika buferi davriy yoziladi
+    start_known_users_warmup()  # Ma'lum foydalanuvchilar uchun add_user bazaga bormaydi
+    start_users_flusher()
+    worker_stop = asyncio.Event()
+    worker_task = asyncio.create_task(run_broadcast_worker(bot, worker_stop)) if RUN_BROADCAST_WORKER else None
+    setup_status()
+    install_update_tracker(dp)
+    install_handler_metrics(dp)
+    register_status_provider("subscription_cache", get_sub_cache_stats)
+    register_status_provider("fsm_storage", storage.stats)
+    register_status_provider("search_index", get_title_index_stats)
     print("✅ Bot ishga tushdi!")
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_URL:
+            # Webhook rejimi: yangilanishlar aiohttp server orqali navbatga tushadi
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop_event.set)
+            await run_webhook(dp, bot, stop_event)
+        else:
+            status_server = await keep_alive()
+            try:
+                await dp.start_polling(bot)
+            finally:
+                await status_server.cleanup()
+    finally:
+        if worker_task is not None:
+            # Worker baza yopilishidan oldin to'xtaydi va olgan bo'lagini qaytaradi
+            worker_stop.set()
+            try:
+                await asyncio.wait_for(worker_task, BROADCAST_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning("Broadcast worker vaqtida to'xtamadi, bekor qilindi")
+            except Exception as e:
+                logging.error(f"Broadcast worker xatosi: {e}")
+        # Polling buni o'zi bajaradi, webhook rejimida esa sessiya ochiq qolardi.
+        # Worker to'xtagandan keyin: u ham shu sessiyadan foydalanadi
+        await bot.session.close()
+        await storage.close()  # Yozilmagan FSM holatlari ham bazaga tushsin
+        await close_db()  # Yozilmagan statistika yo'qolmasin
 
 if __name__ == "__main__":
     try:
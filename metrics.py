@@ -0,0 +1,147 @@
+import math
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Prometheus text formatidagi oddiy metrikalar (tashqi kutubxonasiz)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry: Dict[str, "_Metric"] = {}
+_lock = threading.Lock()
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+    # Eksport qilinadigan nom qo'shimchasi: HELP/TYPE va qiymatlar bir xil nomda bo'ladi
+    name_suffix = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        with _lock:
+            if name in _registry:
+                raise ValueError(f"Metrika allaqachon mavjud: {name}")
+            _registry[name] = self
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        name = self.name + self.name_suffix
+        lines = [
+            f"# HELP {name} {self.documentation}",
+            f"# TYPE {name} {self.kind}",
+        ]
+        for suffix, key, extra, value in self.samples():
+            lines.append(
+                f"{name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+    name_suffix = "_total"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]):
+        """Qiymat har eksportda boshqa joyda yuritilgan hisoblagichdan olinadi (faqat o'sadi)."""
+        self._function = function
+
+    def samples(self):
+        values = self._function() if self._function else self._values
+        for key, value in values.items():
+            yield "", key, "", value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]):
+        """Qiymat har eksportda hisoblanadi: {label_qiymatlari: son}."""
+        self._function = function
+
+    def samples(self):
+        values = self._function() if self._function else self._values
+        for key, value in values.items():
+            yield "", key, "", value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # key -> [bucket_counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+                break
+        data[-2] += value
+        data[-1] += 1
+
+    def summary(self, **labels) -> Tuple[float, int]:
+        """(yig'indi, soni) — o'rtacha qiymatni hisoblash uchun."""
+        data = self._values.get(self._key(labels))
+        return (data[-2], data[-1]) if data else (0.0, 0)
+
+    def samples(self):
+        for key, data in self._values.items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += data[i]
+                yield "_bucket", key, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", key, "", data[-2]
+            yield "_count", key, "", data[-1]
+
+
+def render_prometheus() -> str:
+    """Barcha metrikalarni Prometheus text formatida qaytarish."""
+    return "\n".join(metric.render() for metric in list(_registry.values())) + "\n"
@@ -0,0 +1,106 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Set
+
+# Katalog nomlari bo'yicha xotiradagi trigram indeksi: bazaga bormasdan qidirish
+
+MIN_SCORE = 0.3
+
+# O'zbek kirill -> lotin (nomlar va so'rovlar bitta yozuvda solishtiriladi).
+# Tutuq belgisi quyida baribir olib tashlanadi, shuning uchun ғ -> g, ў -> o
+CYRILLIC_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "ғ": "g", "д": "d", "е": "e", "ё": "yo",
+    "ж": "j", "з": "z", "и": "i", "й": "y", "к": "k", "қ": "q", "л": "l", "м": "m",
+    "н": "n", "о": "o", "ў": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "x", "ҳ": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "",
+    "ь": "", "ы": "i", "э": "e", "ю": "yu", "я": "ya",
+}
+# Tutuq belgisining barcha ko'rinishlari (o', o‘, o`, oʻ ...) olib tashlanadi:
+# "o'zbek", "o‘zbek" va "ozbek" bir xil bo'ladi
+APOSTROPHES = "'‘’`ʻʼ´′"
+
+_TRANSLATION = str.maketrans({
+    **CYRILLIC_TO_LATIN,
+    **{ch: "" for ch in APOSTROPHES},
+})
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    text = (text or "").casefold().translate(_TRANSLATION)
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def trigrams(text: str) -> Set[str]:
+    """pg_trgm kabi: har so'z boshiga ikki, oxiriga bitta bo'sh joy qo'shiladi."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Nomlar indeksi: qo'shish/o'chirish bitta nom uchun, qidiruv — faqat xotirada."""
+
+    def __init__(self):
+        self._titles: Dict[str, str] = {}       # code -> asl nom
+        self._normalized: Dict[str, str] = {}   # code -> normallashgan nom
+        self._postings: Dict[str, Set[str]] = {}  # trigram -> kodlar
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    def build(self, rows: Iterable[dict]):
+        self._titles.clear()
+        self._normalized.clear()
+        self._postings.clear()
+        for row in rows:
+            self.add(row["code"], row["title"])
+
+    def add(self, code: str, title: str):
+        if code in self._titles:
+            self.remove(code)
+        normalized = normalize(title)
+        self._titles[code] = title
+        self._normalized[code] = normalized
+        for gram in trigrams(normalized):
+            self._postings.setdefault(gram, set()).add(code)
+
+    def remove(self, code: str):
+        normalized = self._normalized.pop(code, None)
+        self._titles.pop(code, None)
+        if normalized is None:
+            return
+        for gram in trigrams(normalized):
+            codes = self._postings.get(gram)
+            if codes is not None:
+                codes.discard(code)
+                if not codes:
+                    del self._postings[gram]
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        """Nom bo'yicha o'xshashlik tartibida: qism-satr mosliklari birinchi."""
+        query = normalize(query)
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        overlap = Counter()
+        for gram in query_grams:
+            overlap.update(self._postings.get(gram, ()))
+
+        scored = []
+        for code, shared in overlap.items():
+            title = self._normalized[code]
+            score = shared / len(query_grams)
+            if query in title:
+                score += 1
+                # So'z boshidan mos kelish (yozishni davom ettirayotgan foydalanuvchi uchun)
+                if title.startswith(query) or f" {query}" in title:
+                    score += 0.5
+            if score >= MIN_SCORE:
+                scored.append((-score, title, code))
+        scored.sort()
+        return [{"code": code, "title": self._titles[code]} for _, _, code in scored[:limit]]
@@ -0,0 +1,245 @@
+import os
+import time
+import asyncio
+import inspect
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Update
+
+from metrics import Counter, Gauge, Histogram, render_prometheus
+
+# Webhook rejimi: WEBHOOK_URL berilsa polling o'rniga ishlatiladi
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")          # Masalan: https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")     # Telegram yuboradigan maxfiy sarlavha
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+
+updates_received_metric = Counter(
+    "bot_updates_received", "Webhook orqali qabul qilingan yangilanishlar", ("result",)
+)
+updates_processed_metric = Counter(
+    "bot_updates_processed", "Ishlov berilgan yangilanishlar", ("result",)
+)
+update_queue_depth_metric = Gauge(
+    "bot_update_queue_depth", "Ishlov berishni kutayotgan yangilanishlar"
+)
+update_duration_metric = Histogram(
+    "bot_update_duration_seconds", "Bitta yangilanishga ishlov berish vaqti"
+)
+handler_duration_metric = Histogram(
+    "bot_handler_duration_seconds", "Handler bajarilish vaqti", ("handler", "event")
+)
+handler_errors_metric = Counter(
+    "bot_handler_errors", "Handlerlarda ko'tarilgan xatolar", ("handler", "event")
+)
+
+
+STARTED_AT = time.time()
+
+# Holat sahifasi uchun ma'lumot manbalari: nom -> funksiya (oddiy yoki async)
+_status_providers: Dict[str, Callable[[], Any]] = {}
+# /metrics eksportidan oldin chaqiriladigan async yig'uvchilar (masalan, bazadan son olish)
+_metrics_collectors: list[Callable[[], Awaitable[None]]] = []
+
+_last_update = {"at": None, "count": 0}
+
+
+def register_status_provider(name: str, provider: Callable[[], Any]):
+    _status_providers[name] = provider
+
+
+def register_metrics_collector(collector: Callable[[], Awaitable[None]]):
+    _metrics_collectors.append(collector)
+
+
+class UpdateTrackerMiddleware(BaseMiddleware):
+    """Oxirgi ishlov berilgan yangilanish vaqtini belgilash (polling va webhook uchun)."""
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            _last_update["at"] = time.time()
+            _last_update["count"] += 1
+
+
+def install_update_tracker(dp: Dispatcher):
+    dp.update.outer_middleware(UpdateTrackerMiddleware())
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Har bir handlerning bajarilish vaqti va xatolarini yozish."""
+
+    def __init__(self, event_type: str):
+        self.event_type = event_type
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors_metric.inc(handler=name, event=self.event_type)
+            raise
+        finally:
+            handler_duration_metric.observe(
+                time.perf_counter() - started, handler=name, event=self.event_type
+            )
+
+
+def install_handler_metrics(dp: Dispatcher):
+    # Ichki middleware faqat mos handler topilganda chaqiriladi
+    for event_type, observer in dp.observers.items():
+        if event_type not in ("update", "error"):
+            observer.middleware(HandlerMetricsMiddleware(event_type))
+
+
+class UpdateQueue:
+    """Webhook yangilanishlari uchun chegaralangan navbat va uni bo'shatuvchi workerlar."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, maxsize: int = UPDATE_QUEUE_SIZE, workers: int = UPDATE_WORKERS):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks: list[asyncio.Task] = []
+        update_queue_depth_metric.set_function(lambda: {(): self.queue.qsize()})
+
+    def put(self, update: Update) -> bool:
+        """Navbatga qo'yish. Navbat to'la bo'lsa False."""
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout: float = 10):
+        """Navbatdagi yangilanishlarni tugatib, workerlarni to'xtatish."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self.queue.qsize()} ta yangilanish ishlanmay qoldi")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                await self.dp.feed_update(self.bot, update)
+                updates_processed_metric.inc(result="ok")
+            except Exception as e:
+                updates_processed_metric.inc(result="error")
+                logging.exception(f"Yangilanishga ishlov berishda xato: {e}")
+            finally:
+                update_duration_metric.observe(time.perf_counter() - started)
+                self.queue.task_done()
+
+
+async def _resolve(provider):
+    value = provider()
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    return web.Response(text="Bot tirik!")
+
+
+async def status_handler(request: web.Request) -> web.Response:
+    """Haqiqiy holat: oxirgi yangilanish, pool, navbatdagi yuborishlar, keshlar."""
+    now = time.time()
+    last_at = _last_update["at"]
+    status: Dict[str, Any] = {
+        "status": "ok",
+        "uptime_seconds": round(now - STARTED_AT),
+        "updates_processed": _last_update["count"],
+        "last_update_seconds_ago": round(now - last_at, 1) if last_at else None,
+    }
+    for name, provider in _status_providers.items():
+        try:
+            status[name] = await _resolve(provider)
+        except Exception as e:
+            status[name] = {"error": str(e)}
+            status["status"] = "degraded"
+    return web.json_response(status)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    for collector in _metrics_collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logging.error(f"Metrika yig'ishda xato: {e}")
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+def make_webhook_handler(bot: Bot, update_queue: UpdateQueue):
+    async def webhook_handler(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            updates_received_metric.inc(result="forbidden")
+            return web.Response(status=403)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            updates_received_metric.inc(result="invalid")
+            return web.Response(status=400)
+        # Darhol javob qaytariladi; navbat to'la bo'lsa Telegram keyinroq qayta yuboradi
+        if not update_queue.put(update):
+            updates_received_metric.inc(result="queue_full")
+            return web.Response(status=503)
+        updates_received_metric.inc(result="ok")
+        return web.Response()
+    return webhook_handler
+
+
+def create_app(bot: Optional[Bot] = None, update_queue: Optional[UpdateQueue] = None) -> web.Application:
+    """Holat, health, metrics va (ixtiyoriy) webhook yo'llari bilan aiohttp ilova."""
+    app = web.Application()
+    app.router.add_get("/", status_handler)
+    app.router.add_get("/health", health_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if update_queue is not None:
+        app.router.add_post(WEBHOOK_PATH, make_webhook_handler(bot, update_queue))
+    return app
+
+
+async def start_web_server(app: web.Application, host: str = WEB_HOST, port: int = WEB_PORT) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Web server ishga tushdi: {host}:{port}")
+    return runner
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop_event: asyncio.Event):
+    """Webhook rejimida ishlash: stop_event o'rnatilguncha."""
+    update_queue = UpdateQueue(dp, bot)
+    update_queue.start()
+    runner = await start_web_server(create_app(bot, update_queue))
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    try:
+        await stop_event.wait()
+    finally:
+        # Avval yangi so'rovlar qabul qilinmaydi, keyin navbat bo'shatiladi
+        await runner.cleanup()
+        await update_queue.stop()